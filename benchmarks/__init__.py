@@ -0,0 +1,4 @@
+"""Benchmarks for black-hole.
+
+Run them from the root of the repository, like ``python -m benchmarks.sanitize``.
+"""
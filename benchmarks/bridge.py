@@ -0,0 +1,465 @@
+"""Load tests for the bridge, run entirely offline.
+
+A local aiohttp server stands in for Discord's webhook API (with configurable
+latency, rate limits and injected 429s), synthetic stanzas are fed into
+``Room._on_message``, and synthetic Discord messages into
+``BlackHole.on_discord_message``. Nothing connects to Discord or XMPP.
+
+    python -m benchmarks.bridge [--scenario NAME ...] [options]
+
+For every scenario, the throughput, p50/p99 latency and peak memory allocated
+are reported.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import statistics
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import aioxmpp
+from aiohttp import web
+
+from black_hole import BlackHole, eventloop
+from black_hole.room import Room
+
+MARKER_RE = re.compile(r"#(\d+)#")
+
+
+class FakeWebhookServer:
+    """Stands in for Discord's webhook API."""
+
+    def __init__(self, *, latency, limit, window, inject_429, seed):
+        self.latency = latency
+        self.limit = limit
+        self.window = window
+        self.inject_429 = inject_429
+        self.random = random.Random(seed)
+
+        #: { webhook: (window_started_at, requests_made) }
+        self._buckets = {}
+        self._next_id = 0
+
+        #: { marker: time.perf_counter() at which it was received }
+        self.received = {}
+        self.requests = 0
+        self.statuses = {}
+
+    def _take(self, webhook):
+        now = time.monotonic()
+        started_at, made = self._buckets.get(webhook, (now, 0))
+        if now - started_at >= self.window:
+            started_at, made = now, 0
+
+        reset_after = max(self.window - (now - started_at), 0)
+        if made >= self.limit:
+            return False, 0, reset_after
+
+        self._buckets[webhook] = (started_at, made + 1)
+        return True, self.limit - made - 1, reset_after
+
+    def _respond(self, status, body, headers):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        return web.json_response(body, status=status, headers=headers)
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+        webhook = request.match_info["webhook"]
+        allowed, remaining, reset_after = self._take(webhook)
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+        }
+
+        if not allowed or self.random.random() < self.inject_429:
+            retry_after = reset_after if not allowed else self.window
+            headers["Retry-After"] = f"{retry_after:.3f}"
+            return self._respond(429, {"retry_after": retry_after}, headers)
+
+        payload = await request.json()
+        now = time.perf_counter()
+        for marker in MARKER_RE.findall(payload["content"]):
+            self.received.setdefault(int(marker), now)
+
+        self._next_id += 1
+        return self._respond(200, {"id": str(self._next_id)}, headers)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/webhooks/{webhook}", self.handle)
+        app.router.add_patch("/webhooks/{webhook}/messages/{message}", self.handle)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+
+        _, port = self.runner.addresses[0][:2]
+        return f"http://127.0.0.1:{port}/webhooks"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def make_config(args, base_url):
+    return {
+        "xmpp": {
+            "jid": "bridge@example.com",
+            "password": "benchmark",
+            "outbox": {"rate": args.xmpp_rate},
+        },
+        "rooms": [
+            {
+                "jid": f"room{n}@muc.example.com",
+                "channel_id": 1000 + n,
+                "webhook": [f"{base_url}/{n}-{w}" for w in range(args.webhooks)],
+                "queue": {"size": args.queue_size, "policy": args.policy},
+            }
+            for n in range(args.rooms)
+        ],
+        "discord": {
+            "token": "benchmark",
+            "concurrency": args.concurrency,
+            "coalesce": args.coalesce,
+            "retries": 10,
+        },
+        "tracing": {"sample_rate": args.sample_rate, "slow_threshold": 60},
+        "shutdown_timeout": args.timeout,
+    }
+
+
+def make_stanza(text):
+    msg = aioxmpp.Message(type_=aioxmpp.MessageType.GROUPCHAT)
+    msg.body[None] = text
+    msg.autoset_id()
+    return msg
+
+
+def make_member(n):
+    return SimpleNamespace(
+        nick=f"user{n}", direct_jid=aioxmpp.JID.fromstr(f"user{n}@example.com")
+    )
+
+
+class FakeChannel:
+    def __init__(self, id_, guild, members):
+        self.id = id_
+        self.guild = guild
+        self.members = members
+
+    def permissions_for(self, member):
+        return SimpleNamespace(read_messages=True)
+
+
+class FakeAuthor(SimpleNamespace):
+    def __str__(self):
+        return f"{self.name}#{self.discriminator}"
+
+
+def make_discord_message(channel, author, text, id_):
+    return SimpleNamespace(
+        id=id_,
+        webhook_id=None,
+        channel=channel,
+        guild=channel.guild,
+        author=author,
+        content=text,
+        system_content=text,
+        attachments=[],
+        embeds=[],
+        raw_mentions=[],
+        raw_role_mentions=[],
+    )
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(name, sent, received, started, memory):
+    latencies = [received[marker] - sent[marker] for marker in received]
+    elapsed = (max(received.values()) - started) if received else float("nan")
+
+    return {
+        "scenario": name,
+        "sent": len(sent),
+        "delivered": len(received),
+        "throughput": len(received) / elapsed if received else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else float("nan"),
+        "peak_memory_kib": memory / 1024,
+    }
+
+
+async def close(bh):
+    for lane in bh.discord._lanes.values():
+        lane._task.cancel()
+    for outbox in bh.xmpp._outboxes.values():
+        outbox._task.cancel()
+    for room in bh.xmpp.rooms.values():
+        room._task.cancel()
+    await bh.discord.transport.close()
+
+
+async def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def run_to_discord(name, args, *, hot_rooms, hot_messages, cold_messages):
+    """Feed stanzas into rooms: ``hot_rooms`` get ``hot_messages`` at once,
+    the rest get ``cold_messages`` spread over the duration of the run.
+    """
+    server = FakeWebhookServer(
+        latency=args.latency,
+        limit=args.limit,
+        window=args.window,
+        inject_429=args.inject_429 if "429" in name else 0.0,
+        seed=args.seed,
+    )
+    base_url = await server.start()
+
+    tracemalloc.start()
+    bh = BlackHole(config=make_config(args, base_url))
+
+    rooms = []
+    for room_config in bh.router.rooms:
+        room = bh.xmpp.rooms[room_config.jid] = Room(bh.xmpp, jid=room_config.jid)
+        room.room = SimpleNamespace(me=object())
+        rooms.append(room)
+
+    members = [make_member(n) for n in range(5)]
+    rng = random.Random(args.seed)
+    sent = {}
+    marker = 0
+
+    def feed(room, count):
+        nonlocal marker
+        for _ in range(count):
+            marker += 1
+            sent[marker] = time.perf_counter()
+            member = members[rng.randrange(len(members))]
+            room._on_message(make_stanza(f"message #{marker}#"), member, None)
+
+    started = time.perf_counter()
+    for room in rooms[:hot_rooms]:
+        feed(room, hot_messages)
+
+    for _ in range(cold_messages):
+        for room in rooms[hot_rooms:]:
+            feed(room, 1)
+        await asyncio.sleep(args.interval)
+
+    await wait_for(lambda: len(server.received) >= len(sent), args.timeout)
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = report(name, sent, dict(server.received), started, peak)
+    result["requests"] = server.requests
+    result["statuses"] = server.statuses
+
+    cold = {m: t for m, t in server.received.items() if m > hot_rooms * hot_messages}
+    if hot_rooms and cold:
+        latencies = [cold[m] - sent[m] for m in cold]
+        result["cold_p99_ms"] = percentile(latencies, 0.99) * 1000
+
+    await close(bh)
+    await server.stop()
+    return result
+
+
+async def run_to_xmpp(name, args):
+    """Feed Discord messages into the bridge, measuring until client.send."""
+    tracemalloc.start()
+    bh = BlackHole(config=make_config(args, "http://127.0.0.1:9/webhooks"))
+
+    guild = SimpleNamespace(id=1, get_role=lambda id_: None)
+    authors = [
+        FakeAuthor(id=n, name=f"user{n % 40}", discriminator=f"{n:04}")
+        for n in range(50)
+    ]
+    channels = [
+        FakeChannel(room.channel_id, guild, authors) for room in bh.router.rooms
+    ]
+
+    sent = {}
+    received = {}
+
+    async def send(stanza):
+        (marker,) = MARKER_RE.findall(stanza.body.any())
+        received[int(marker)] = time.perf_counter()
+
+    bh.xmpp.client.send = send
+    bh.xmpp.client.established_event.set()
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    total = args.messages * len(channels)
+    for marker in range(1, total + 1):
+        channel = channels[marker % len(channels)]
+        author = authors[rng.randrange(len(authors))]
+        message = make_discord_message(channel, author, f"message #{marker}#", marker)
+        sent[marker] = time.perf_counter()
+        await bh.on_discord_message(message)
+
+    await wait_for(lambda: len(received) >= len(sent), args.timeout)
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    await close(bh)
+    return report(name, sent, received, started, peak)
+
+
+async def run_shutdown(name, args):
+    """Queue up messages in every room and shut down right away, measuring how
+    many are delivered before the bridge stops.
+    """
+    server = FakeWebhookServer(
+        latency=args.latency,
+        limit=args.limit,
+        window=args.window,
+        inject_429=0.0,
+        seed=args.seed,
+    )
+    base_url = await server.start()
+
+    tracemalloc.start()
+    bh = BlackHole(config=make_config(args, base_url))
+
+    rooms = []
+    for room_config in bh.router.rooms:
+        room = bh.xmpp.rooms[room_config.jid] = Room(bh.xmpp, jid=room_config.jid)
+        room.room = SimpleNamespace(me=object())
+        rooms.append(room)
+
+    members = [make_member(n) for n in range(5)]
+    sent = {}
+    marker = 0
+
+    started = time.perf_counter()
+    for room in rooms:
+        for _ in range(args.messages):
+            marker += 1
+            sent[marker] = time.perf_counter()
+            room._on_message(make_stanza(f"message #{marker}#"), members[0], None)
+
+    await bh.shutdown()
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = report(name, sent, dict(server.received), started, peak)
+    result["shutdown_s"] = time.perf_counter() - started
+
+    await server.stop()
+    return result
+
+
+SCENARIOS = {
+    # every room talks at the same, steady pace
+    "steady": lambda args: run_to_discord(
+        "steady", args, hot_rooms=0, hot_messages=0, cold_messages=args.messages
+    ),
+    # one room floods while the others keep talking
+    "burst": lambda args: run_to_discord(
+        "burst",
+        args,
+        hot_rooms=1,
+        hot_messages=args.messages * 5,
+        cold_messages=args.messages,
+    ),
+    # like burst, with 429s injected on top of the regular rate limits
+    "burst-429": lambda args: run_to_discord(
+        "burst-429",
+        args,
+        hot_rooms=1,
+        hot_messages=args.messages * 5,
+        cold_messages=args.messages,
+    ),
+    # discord -> xmpp
+    "to-xmpp": lambda args: run_to_xmpp("to-xmpp", args),
+    # every room floods, and the bridge is shut down right away
+    "shutdown": lambda args: run_shutdown("shutdown", args),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="scenario to run, can be repeated (default: all)",
+    )
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument(
+        "--messages", type=int, default=50, help="messages per room (scaled)"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=0.01, help="seconds between steady sends"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="webhook response latency"
+    )
+    parser.add_argument("--limit", type=int, default=5, help="requests per window")
+    parser.add_argument(
+        "--window", type=float, default=1.0, help="rate limit window in seconds"
+    )
+    parser.add_argument(
+        "--inject-429", type=float, default=0.05, help="chance of a spurious 429"
+    )
+    parser.add_argument("--webhooks", type=int, default=1, help="webhooks per room")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--coalesce", type=float, default=0)
+    parser.add_argument("--queue-size", type=int, default=100000)
+    parser.add_argument("--policy", default="drop-oldest")
+    parser.add_argument(
+        "--xmpp-rate", type=float, default=0, help="stanzas per second per room"
+    )
+    parser.add_argument(
+        "--sample-rate", type=float, default=0, help="fraction of messages traced"
+    )
+    parser.add_argument("--loop", choices=eventloop.IMPLEMENTATIONS, default="asyncio")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    eventloop.install(args.loop)
+    loop = asyncio.get_event_loop()
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        results.append(loop.run_until_complete(SCENARIOS[name](args)))
+
+    # let cancelled tasks finish
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print(f"{result['scenario']}:")
+        for key, value in result.items():
+            if key == "scenario":
+                continue
+            if isinstance(value, float):
+                value = f"{value:.2f}"
+            print(f"  {key:<16} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Micro-benchmarks for mention sanitizing, comparing black_hole.sanitize to the
+implementations it replaced.
+
+    python -m benchmarks.sanitize [--number N]
+"""
+
+import argparse
+import asyncio
+import re
+import timeit
+from collections import namedtuple
+
+from discord.ext import commands
+
+from black_hole.sanitize import Sanitizer, clean_content
+
+# --- the previous implementations -------------------------------------------
+
+MENTION_RE = re.compile(r"<@[!&]?(\d+)>")
+FakeContext = namedtuple("FakeContext", ("message", "guild", "bot"))
+
+
+def _replacer(match):
+    return match.group(0).strip("<>")
+
+
+def old_clean_content(content: str) -> str:
+    content = content.replace("@everyone", "@\u200beveryone").replace(
+        "@here", "@\u200bhere"
+    )
+
+    content = MENTION_RE.sub(_replacer, content)
+    return content
+
+
+async def old_format(client, message, content):
+    cleaner = commands.clean_content(use_nicknames=False)
+    ctx = FakeContext(message, message.guild, client)
+    return await cleaner.convert(ctx, content)
+
+
+# --- fakes --------------------------------------------------------------------
+
+
+class FakeNamed:
+    def __init__(self, id_, name):
+        self.id = id_
+        self.name = name
+
+
+class FakeClient:
+    def __init__(self, users):
+        self.users = {user.id: user for user in users}
+
+    def get_user(self, id_):
+        return self.users.get(id_)
+
+    def add_listener(self, func, name):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, roles):
+        self.roles = {role.id: role for role in roles}
+
+    def get_role(self, id_):
+        return self.roles.get(id_)
+
+
+class FakeMessage:
+    def __init__(self, content, guild):
+        self.content = content
+        self.guild = guild
+        self.raw_mentions = [int(x) for x in re.findall(r"<@!?([0-9]+)>", content)]
+        self.raw_role_mentions = [int(x) for x in re.findall(r"<@&([0-9]+)>", content)]
+        # users the fake client knows about are resolved from its cache
+        self.mentions = []
+
+
+USERS = [FakeNamed(100000000000000000 + n, f"user{n}") for n in range(50)]
+USERS.append(FakeNamed(123456789012345678, "everyone"))
+ROLES = [FakeNamed(200000000000000000 + n, f"role{n}") for n in range(10)]
+
+TO_DISCORD = [
+    "hello world",
+    "most messages don't mention anybody",
+    "like this one",
+    "@everyone look at this",
+    "hey <@123> and <@!456>, <@&789> @here",
+    "no mentions at all, just a fairly long line of text " * 10,
+    "<@everyone> @@here <@<@1>>",
+]
+
+FROM_DISCORD = [
+    "hello world",
+    "most messages don't mention anybody",
+    "hey <@100000000000000001> and <@!100000000000000002>",
+    "<@&200000000000000003> @everyone @here",
+    "<@999999999999999999> is gone, and so is <@&299999999999999999>",
+    "<@123456789012345678> <@0100000000000000001> @123456789012345678",
+    "no mentions at all, just a fairly long line of text " * 10,
+]
+
+
+def check(sanitizer, client, guild):
+    """Make sure that the new implementations give the same output."""
+    loop = asyncio.get_event_loop()
+
+    for content in TO_DISCORD:
+        assert clean_content(content) == old_clean_content(content), content
+
+    for content in FROM_DISCORD:
+        message = FakeMessage(content, guild)
+        # also append something that isn't part of the content, like an
+        # attachment url would be
+        argument = content + " <@100000000000000004> https://example.com/a.png"
+        old = loop.run_until_complete(old_format(client, message, argument))
+        new = sanitizer.clean(message, argument)
+        assert old == new, (content, old, new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    client = FakeClient(USERS)
+    guild = FakeGuild(ROLES)
+    sanitizer = Sanitizer(client)
+
+    check(sanitizer, client, guild)
+    print("outputs are identical")
+
+    loop = asyncio.get_event_loop()
+    messages = [FakeMessage(content, guild) for content in FROM_DISCORD]
+
+    def bench(name, func):
+        seconds = timeit.timeit(func, number=args.number)
+        per_call = seconds / args.number * 1e6
+        print(f"{name:<32} {per_call:8.2f} µs/iteration")
+        return per_call
+
+    print(f"\nxmpp -> discord ({len(TO_DISCORD)} messages per iteration)")
+    old = bench("old clean_content", lambda: [old_clean_content(c) for c in TO_DISCORD])
+    new = bench(
+        "sanitize.clean_content", lambda: [clean_content(c) for c in TO_DISCORD]
+    )
+    print(f"speedup: {old / new:.2f}x")
+
+    print(f"\ndiscord -> xmpp ({len(messages)} messages per iteration)")
+
+    async def old_all():
+        for message in messages:
+            await old_format(client, message, message.content)
+
+    old = bench("commands.clean_content", lambda: loop.run_until_complete(old_all()))
+    new = bench(
+        "Sanitizer.clean",
+        lambda: [sanitizer.clean(message, message.content) for message in messages],
+    )
+    print(f"speedup: {old / new:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
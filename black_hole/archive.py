@@ -0,0 +1,123 @@
+"""This module fetches messages from MUC archives (:xep:`313`).
+
+It's used to catch up on messages that were sent to a MUC while we weren't in
+it, e.g. after the stream was lost and couldn't be resumed.
+"""
+
+__all__ = ["Archive", "ArchivedOccupant"]
+
+import asyncio
+import logging
+import uuid
+
+import aioxmpp
+import aioxmpp.disco
+import aioxmpp.rsm.xso as rsm
+from aioxmpp.utils import namespaces
+
+from .xso import MAMQuery
+
+log = logging.getLogger(__name__)
+
+
+class ArchivedOccupant:
+    """Stands in for the :class:`aioxmpp.muc.Occupant` that sent an archived
+    message, which may not be in the MUC anymore.
+    """
+
+    __slots__ = ("nick", "direct_jid")
+
+    def __init__(self, nick, direct_jid=None):
+        self.nick = nick
+        self.direct_jid = direct_jid
+
+    @classmethod
+    def from_message(cls, msg):
+        direct_jid = None
+        muc_user = msg.xep0045_muc_user
+        if muc_user is not None and muc_user.items and muc_user.items[0].jid:
+            direct_jid = muc_user.items[0].jid.bare()
+
+        return cls(msg.from_.resource, direct_jid)
+
+
+class Archive:
+    """Queries MUC archives, in pages of ``page_size`` messages."""
+
+    def __init__(self, client, *, page_size: int = 50, max_pages: int = 20):
+        self.client = client
+        self.disco = client.summon(aioxmpp.DiscoClient)
+        self.page_size = page_size
+
+        #: The maximum amount of pages fetched in a single catch up, so a long
+        #: outage doesn't flood Discord.
+        self.max_pages = max_pages
+
+        #: { str: [aioxmpp.Message] }
+        # results of the queries in progress, by query id
+        self._results = {}
+
+        client.stream.app_inbound_message_filter.register(self._filter, 0)
+
+    def _filter(self, msg):
+        result = msg.xep0313_result
+        if result is None or result.queryid not in self._results:
+            return msg
+
+        forwarded = result.forwarded
+        if forwarded is not None and forwarded.stanza is not None:
+            self._results[result.queryid].append((result.id_, forwarded.stanza))
+
+        # results of our own queries don't go any further
+        return None
+
+    async def supported(self, jid: aioxmpp.JID) -> bool:
+        """Check if a MUC keeps an archive we can query."""
+        try:
+            info = await self.disco.query_info(jid)
+        except (aioxmpp.errors.XMPPError, asyncio.TimeoutError) as error:
+            log.debug("[%s] failed to query features: %r", jid, error)
+            return False
+
+        return namespaces.xep0313_mam in info.features
+
+    async def _query(self, jid, after):
+        queryid = uuid.uuid4().hex
+        self._results[queryid] = page = []
+
+        page_request = rsm.ResultSetMetadata()
+        page_request.max_ = self.page_size
+        page_request.after = rsm.After(after)
+
+        iq = aioxmpp.IQ(
+            type_=aioxmpp.IQType.SET, to=jid, payload=MAMQuery(queryid, page_request)
+        )
+        try:
+            fin = await self.client.send(iq)
+        finally:
+            del self._results[queryid]
+
+        return page, fin
+
+    async def fetch(self, jid: aioxmpp.JID, after: str):
+        """Fetch the messages that were archived after the stanza with an ID
+        of ``after``, oldest first.
+
+        Returns a list of ``(stanza_id, message)`` tuples.
+        """
+        messages = []
+
+        for _ in range(self.max_pages):
+            page, fin = await self._query(jid, after)
+            messages.extend(page)
+
+            if fin is None or fin.complete or not page:
+                return messages
+
+            if fin.rsm is None or fin.rsm.last is None:
+                return messages
+
+            after = fin.rsm.last.value
+
+        log.warning("[%s] stopped catching up after %d messages", jid, len(messages))
+        return messages
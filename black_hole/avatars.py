@@ -0,0 +1,123 @@
+__all__ = ["AvatarCache"]
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from discord import HTTPException, NotFound
+
+log = logging.getLogger(__name__)
+
+
+class AvatarCache:
+    """A bounded cache of avatar URLs of Discord users that aren't in the
+    client's cache.
+
+    Fetching a user is heavily rate limited, so:
+
+    - concurrent lookups of the same user share a single fetch,
+    - expired entries are still returned, while being refreshed in the
+      background,
+    - the least recently used entries are evicted once the cache is full.
+    """
+
+    def __init__(self, client, *, ttl: float, max_size: int):
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+
+        #: { int: (float, Optional[str]) }
+        # maps user ids to the monotonic timestamp at which their entry
+        # expires, and their avatar url (None if the user doesn't exist).
+        self._entries = OrderedDict()
+
+        #: { int: asyncio.Task }
+        self._inflight = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, user_id: int) -> Optional[str]:
+        """Get the avatar url of a user."""
+        entry = self._entries.get(user_id)
+
+        if entry is None:
+            self.misses += 1
+            return await self._fetch(user_id)
+
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+
+        expires_at, avatar_url = entry
+        if time.monotonic() > expires_at:
+            # serve the stale entry, it'll be fresh the next time around
+            self.prefetch(user_id)
+
+        return avatar_url
+
+    def prefetch(self, user_id: int):
+        """Fetch a user in the background, unless it's already cached and
+        fresh.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() <= entry[0]:
+            return
+
+        self._task_for(user_id)
+
+    def _task_for(self, user_id: int) -> asyncio.Task:
+        """Get the task fetching a user, starting one if there's none, so that
+        everyone fetching the same user at the same time shares one fetch.
+        """
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = self.client.loop.create_task(self._do_fetch(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda task: self._fetched(user_id, task))
+        return task
+
+    def _fetched(self, user_id: int, task: asyncio.Task):
+        self._inflight.pop(user_id, None)
+
+        if not task.cancelled() and task.exception() is not None:
+            log.error("failed to fetch user %d", user_id, exc_info=task.exception())
+
+    async def _fetch(self, user_id: int) -> Optional[str]:
+        # a cancelled waiter shouldn't cancel the fetch for everyone else
+        return await asyncio.shield(self._task_for(user_id))
+
+    async def _do_fetch(self, user_id: int) -> Optional[str]:
+        try:
+            user = await self.client.fetch_user(user_id)
+        except NotFound:
+            # write that in cache so we don't need to keep checking later on
+            avatar_url = None
+        except HTTPException:
+            log.warning("failed to fetch user %d", user_id, exc_info=True)
+
+            # keep serving whatever we had before
+            entry = self._entries.get(user_id)
+            return None if entry is None else entry[1]
+        else:
+            avatar_url = str(user.avatar_url_as(format="png"))
+
+        self._entries[user_id] = (time.monotonic() + self.ttl, avatar_url)
+        self._entries.move_to_end(user_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        return avatar_url
+
+    async def warm(self, user_ids):
+        """Fetch users ahead of time, one after another."""
+        for user_id in user_ids:
+            if user_id in self._entries:
+                continue
+
+            await self._fetch(user_id)
@@ -2,61 +2,160 @@ __all__ = ["BlackHole"]
 
 import asyncio
 import logging
+import signal
+import time
 
 from .xmpp import XMPP
+from .config import ConfigFile
 from .discord import Discord
+from .media import MediaRelay
+from .routing import Router, RoutingTable
+from .tracing import Tracer
+from . import metrics
 
 log = logging.getLogger(__name__)
 
+#: Options that are only read on startup, as ``(section, key)`` pairs, where
+#: ``section`` is ``None`` for top-level options.
+RESTART_OPTIONS = (
+    ("xmpp", "jid"),
+    ("xmpp", "password"),
+    ("xmpp", "resumption_timeout"),
+    ("xmpp", "catch_up"),
+    ("xmpp", "message_map"),
+    ("xmpp", "join_concurrency"),
+    ("xmpp", "concurrency"),
+    ("xmpp", "inbox_size"),
+    ("discord", "token"),
+    ("discord", "lazy_members"),
+    ("discord", "transport"),
+    ("discord", "concurrency"),
+    ("discord", "avatar_cache"),
+    ("discord", "avatar_cache_size"),
+    ("discord", "journal"),
+    ("discord", "message_store"),
+    (None, "loop"),
+    (None, "media"),
+    (None, "metrics"),
+)
+
 
 class BlackHole:
     """The main class that boots up an XMPP client and a Discord client,
     and handles message passing between the two.
     """
 
-    def __init__(self, *, config):
+    def __init__(self, *, config, config_path=None, gateway=True):
         self.config = config
 
+        #: Whether to connect to the Discord gateway. Without it, messages are
+        #: only bridged from XMPP to Discord, unless they're relayed to us
+        #: (see :mod:`black_hole.sharding`).
+        self.gateway = gateway
+
         self.loop = asyncio.get_event_loop()
 
+        #: Set once we're shutting down, after which no new messages from
+        #: Discord are taken in.
+        self.stopping = False
+
+        self._tasks = {}
+        self._shutdown_task = None
+
+        self.config_file = None
+        if config_path is not None:
+            self.config_file = ConfigFile(config_path, config, loop=self.loop)
+            self.config_file.on_reload.append(self.on_config_reload)
+
+        self.router = Router(config)
+        self.tracer = Tracer(config)
+
+        self.media = None
+        if config.get("media") is not None:
+            self.media = MediaRelay(config["media"])
+
+        self.discord = Discord(
+            config=config,
+            router=self.router,
+            config_file=self.config_file,
+            tracer=self.tracer,
+            media=self.media,
+        )
+
         self.xmpp = XMPP(
             config["xmpp"]["jid"],
             config["xmpp"]["password"],
             config=config,
+            router=self.router,
+            discord=self.discord,
+            tracer=self.tracer,
+            media=self.media,
         )
 
         # Register an event handler when we get a message from MUCs.
         self.xmpp.on_message(self.on_xmpp_message)
 
-        self.discord = Discord(config=config)
-
         self.discord.client.add_listener(self.on_discord_message, "on_message")
         self.discord.client.add_listener(
             self.on_discord_message_edit, "on_message_edit"
         )
+        self.discord.client.add_listener(
+            self.on_discord_message_delete, "on_raw_message_delete"
+        )
+        self.discord.client.add_listener(
+            self.on_discord_bulk_message_delete, "on_raw_bulk_message_delete"
+        )
+
+    def on_config_reload(self, config):
+        """Apply a configuration that was changed on disk."""
+        # make sure the rooms are valid before touching anything
+        RoutingTable(config["rooms"])
+
+        for section, key in RESTART_OPTIONS:
+            if section is None:
+                changed = config.get(key) != self.config.get(key)
+            else:
+                changed = config[section].get(key) != self.config[section].get(key)
+
+            if changed:
+                name = key if section is None else f"{section}.{key}"
+                log.warning("%s changed, restart to apply it", name)
 
-    async def on_xmpp_message(self, room, msg, member, source):
+        # everything holds a reference to the same dict, so update it in place
+        self.config.clear()
+        self.config.update(config)
+
+        self.router.rebuild()
+        self.discord.reconfigure_lanes()
+        self.xmpp.reconfigure_outboxes()
+        self.loop.create_task(self.xmpp.sync_rooms())
+
+    async def on_xmpp_message(
+        self, room, msg, member, source, *, received_at, trace=None
+    ):
         """Bridge a MUC message to its Discord channel."""
-        if room.config.get("disabled", False):
+        if room.config is None or room.config.disabled:
             return
 
         try:
-            await self.discord.bridge(room, msg, member, source)
+            await self.discord.bridge(
+                room, msg, member, source, received_at=received_at, trace=trace
+            )
         except Exception:
             log.exception("failed to bridge a message from xmpp to discord")
 
     async def on_discord_message(self, message):
         """Bridge a Discord message to its MUC."""
-        if message.webhook_id is not None:
+        if message.webhook_id is not None or self.stopping:
             return
 
         try:
-            await self.xmpp.bridge(self.discord.client, message)
+            await self.xmpp.bridge(message, received_at=time.time())
         except Exception:
             log.exception("failed to bridge a message from discord to xmpp")
 
     async def on_discord_message_edit(self, before, after):
-        if after.webhook_id is not None:
+        if after.webhook_id is not None or self.stopping:
             return
 
         if before.content == after.content:
@@ -65,21 +164,133 @@ class BlackHole:
             return
 
         try:
-            await self.xmpp.bridge(self.discord.client, after, edited=True)
+            await self.xmpp.bridge(after, edited=True, received_at=time.time())
         except Exception:
             log.exception("failed to bridge an edit from discord to xmpp")
 
+    def _retract(self, channel_id, message_ids):
+        room = self.router.by_channel(channel_id)
+        if room is None or room.disabled or self.stopping:
+            return
+
+        for message_id in message_ids:
+            self.xmpp.retract(room, message_id)
+
+    async def on_discord_message_delete(self, payload):
+        # raw events are used, as deleted messages may not be cached
+        self._retract(payload.channel_id, [payload.message_id])
+
+    async def on_discord_bulk_message_delete(self, payload):
+        self._retract(payload.channel_id, payload.message_ids)
+
+    async def _drain(self):
+        # handling messages from MUCs queues them up for discord, so inboxes
+        # go first
+        await self.xmpp.drain_inboxes()
+        await asyncio.gather(self.discord.drain(), self.xmpp.drain_outboxes())
+
+    async def shutdown(self):
+        """Stop taking in messages, wait for the ones already taken in to be
+        bridged (for up to ``shutdown_timeout`` seconds), and close everything.
+        """
+        timeout = self.config.get("shutdown_timeout", 10)
+        log.info("stopping, draining queues for up to %ds", timeout)
+
+        self.stopping = True
+        self.xmpp.receiving = False
+
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(
+                "gave up draining after %ds: %d messages to discord and %d to xmpp "
+                "weren't sent",
+                timeout,
+                self.discord.pending,
+                self.xmpp.pending,
+            )
+        else:
+            log.info("drained queues in %.2fs", time.monotonic() - started_at)
+
+        self.xmpp.close()
+        await self.discord.close()
+
+        for name in ("xmpp", "config", "discord"):
+            task = self._tasks.get(name)
+            if task is not None:
+                task.cancel()
+
+        # leaving the stream's context manager disconnects cleanly
+        if "xmpp" in self._tasks:
+            try:
+                await asyncio.wait_for(self._tasks["xmpp"], 5)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                pass
+            except Exception:
+                log.exception("failed to disconnect from xmpp")
+
+        if self.media is not None:
+            await self.media.close()
+
+        if self.config_file is not None and self.config_file.pending:
+            await self.config_file.flush()
+
+        metrics_task = self._tasks.get("metrics")
+        if metrics_task is not None and metrics_task.done():
+            if not metrics_task.cancelled() and metrics_task.exception() is None:
+                await metrics_task.result().cleanup()
+
+        log.info("stopped")
+
+    def stop(self):
+        """Shut down gracefully, then stop the event loop."""
+        if self._shutdown_task is not None:
+            return
+
+        async def shutdown():
+            try:
+                await self.shutdown()
+            finally:
+                self.loop.stop()
+
+        self._shutdown_task = self.loop.create_task(shutdown())
+
     def run(self):
         log.info("booting services")
-        self.loop.create_task(self.discord.boot())
-        self.loop.create_task(self.xmpp.boot())
+        self._tasks["discord"] = self.loop.create_task(
+            self.discord.boot(gateway=self.gateway)
+        )
+        self._tasks["xmpp"] = self.loop.create_task(self.xmpp.boot())
+
+        if self.config_file is not None:
+            self._tasks["config"] = self.loop.create_task(self.config_file.watch())
+
+        metrics_config = self.config.get("metrics")
+        if metrics_config is not None:
+            self._tasks["metrics"] = self.loop.create_task(
+                metrics.serve(
+                    metrics_config.get("host", "127.0.0.1"),
+                    metrics_config.get("port", 9100),
+                )
+            )
+
+        # when sharded, the supervisor serves media for every worker
+        if self.media is not None and self.config["media"].get("serve", True):
+            self._tasks["media"] = self.loop.create_task(self.media.serve())
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.stop)
+            except NotImplementedError:
+                # not available on windows, where ctrl+c still raises
+                # KeyboardInterrupt
+                pass
 
         try:
             self.loop.run_forever()
         except KeyboardInterrupt:
-            log.info("stopping")
-            self.xmpp.client.stop()
-            self.loop.run_until_complete(self.discord.client.logout())
+            self.loop.run_until_complete(self.shutdown())
         finally:
             self.loop.close()
 
@@ -0,0 +1,146 @@
+"""This module persists the configuration, and reloads it when it changes.
+
+Saving happens off the event loop: the configuration is snapshotted, then
+serialized and written to a temporary file in an executor, which is renamed
+over the configuration file so a crash mid-write can never truncate it. Saves
+requested in quick succession are debounced into one.
+
+The configuration file is also watched for changes made by hand, in which case
+it's loaded again and handed to whoever is interested.
+"""
+
+__all__ = ["ConfigFile"]
+
+import asyncio
+import copy
+import logging
+import os
+
+from ruamel.yaml import YAML
+
+log = logging.getLogger(__name__)
+
+
+def _yaml():
+    yaml = YAML(typ="safe")
+    yaml.default_flow_style = False
+    return yaml
+
+
+def load(path: str):
+    """Load a configuration file."""
+    with open(path, "r") as fp:
+        return _yaml().load(fp)
+
+
+class ConfigFile:
+    """A configuration file that can be saved in the background and reloaded
+    on changes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        config,
+        *,
+        loop,
+        debounce: float = 1.0,
+        watch_interval: float = 2.0,
+    ):
+        self.path = path
+        self.config = config
+        self.loop = loop
+        self.debounce = debounce
+        self.watch_interval = watch_interval
+
+        #: Functions called with the new configuration when it was changed on
+        #: disk.
+        self.on_reload = []
+
+        #: Functions called after the configuration was saved.
+        self.on_save = []
+
+        self._save_handle = None
+        self._lock = asyncio.Lock()
+        self._mtime = self._stat()
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @property
+    def pending(self) -> bool:
+        """Whether a save has been requested but hasn't happened yet."""
+        return self._save_handle is not None
+
+    def save(self):
+        """Save the configuration in a bit, without blocking."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+
+        self._save_handle = self.loop.call_later(
+            self.debounce, lambda: self.loop.create_task(self.flush())
+        )
+
+    def _write(self, snapshot):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as fp:
+            _yaml().dump(snapshot, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(temporary_path, self.path)
+        return self._stat()
+
+    async def flush(self):
+        """Save the configuration right away."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+
+        async with self._lock:
+            # the configuration may change while we're writing it in another
+            # thread, so write a copy of it
+            snapshot = copy.deepcopy(self.config)
+
+            try:
+                mtime = await self.loop.run_in_executor(None, self._write, snapshot)
+            except Exception:
+                log.exception("failed to save configuration to %s", self.path)
+                return
+
+            # don't reload the changes we just made
+            self._mtime = mtime
+            log.debug("saved configuration to %s", self.path)
+
+        for callback in self.on_save:
+            try:
+                callback()
+            except Exception:
+                log.exception("failed to handle saved configuration")
+
+    async def watch(self):
+        """Reload the configuration whenever the file changes."""
+        while True:
+            await asyncio.sleep(self.watch_interval)
+
+            mtime = self._stat()
+            if mtime is None or mtime == self._mtime or self._lock.locked():
+                continue
+
+            self._mtime = mtime
+
+            try:
+                config = await self.loop.run_in_executor(None, load, self.path)
+            except Exception:
+                log.exception("failed to reload configuration from %s", self.path)
+                continue
+
+            log.info("configuration changed, reloading")
+            for callback in self.on_reload:
+                try:
+                    callback(config)
+                except Exception:
+                    log.exception("failed to apply reloaded configuration")
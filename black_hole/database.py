@@ -0,0 +1,83 @@
+"""This module wraps SQLite databases that are written to in the background.
+
+Writes are queued, then committed together in one transaction every
+``commit_interval`` seconds from a single worker thread, so the event loop never
+blocks on disk and the cost of a commit is shared by every write in it.
+"""
+
+__all__ = ["Database"]
+
+import asyncio
+import itertools
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class Database:
+    """A SQLite database with batched, background writes."""
+
+    def __init__(self, path: str, *, loop, schema: str, commit_interval: float):
+        self.path = path
+        self.loop = loop
+        self.commit_interval = commit_interval
+
+        # sqlite connections may only be used from one thread at a time, all
+        # queries after setup happen on this executor's single thread.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(schema)
+
+        #: [(str, tuple)]
+        self._writes = []
+        self._dirty = asyncio.Event()
+        self._task = loop.create_task(self._committer())
+
+    def query(self, sql: str, params=()) -> list:
+        """Run a query right away, blocking. Only meant to be used on startup."""
+        return self._db.execute(sql, params).fetchall()
+
+    async def fetch(self, sql: str, params=()) -> list:
+        """Run a query in the background."""
+        return await self.loop.run_in_executor(self._executor, self.query, sql, params)
+
+    def write(self, sql: str, params=()):
+        """Queue a write, to be committed with the next batch."""
+        self._writes.append((sql, params))
+        self._dirty.set()
+
+    def _commit(self, writes):
+        with self._db:
+            # consecutive writes of the same statement are executed together
+            for sql, group in itertools.groupby(writes, key=lambda write: write[0]):
+                self._db.executemany(sql, [params for _, params in group])
+
+    async def flush(self):
+        """Commit every queued write."""
+        writes, self._writes = self._writes, []
+        self._dirty.clear()
+
+        if not writes:
+            return
+
+        try:
+            await self.loop.run_in_executor(self._executor, self._commit, writes)
+        except Exception:
+            log.exception("failed to commit %d writes to %s", len(writes), self.path)
+
+    async def _committer(self):
+        while True:
+            await self._dirty.wait()
+
+            # let writes pile up for a bit so they get committed together
+            await asyncio.sleep(self.commit_interval)
+            await self.flush()
+
+    def close(self):
+        self._task.cancel()
+        self._executor.shutdown(wait=True)
+        self._db.close()
@@ -1,17 +1,26 @@
 __all__ = ["Discord"]
 
 import asyncio
+import json
 import logging
+import resource
 import time
 from typing import Optional
 
-import aiohttp
 from discord.ext import commands
-from discord import DiscordException, Intents
-from expiringdict import ExpiringDict
+from discord import Intents
 
+from .avatars import AvatarCache
+from .journal import Journal
+from .lane import MAX_CONTENT_LENGTH, Lane
 from .management import Management
-from .utils import clean_content
+from .members import NameIndex
+from . import metrics
+from .ratelimit import RateLimiter
+from .sanitize import Sanitizer, clean_content
+from .store import MessageStore
+from .tracing import Tracer
+from .transport import WebhookTransport, backoff, dumps, is_retriable
 
 log = logging.getLogger(__name__)
 
@@ -27,36 +36,145 @@ def ensure_valid_nick(nick: str) -> str:
     return nick
 
 
+def is_dead_webhook(status: int, body: bytes) -> bool:
+    """Check if an error response means the webhook is gone for good."""
+    if status not in (401, 404):
+        return False
+
+    try:
+        code = json.loads(body).get("code")
+    except (ValueError, AttributeError):
+        return False
+
+    # unknown webhook, invalid webhook token
+    return code in (10015, 50027)
+
+
+def correct_segments(segments, original_id, new_id, content: str) -> str:
+    """Apply a correction to the segments of a coalesced message, returning the
+    new content of the entire message.
+    """
+    for segment in segments:
+        if original_id in segment["ids"]:
+            segment["content"] = content
+            segment["ids"].append(new_id)
+            break
+
+    return "\n".join(segment["content"] for segment in segments)[:MAX_CONTENT_LENGTH]
+
+
+def make_client(*, lazy_members: bool = False) -> commands.Bot:
+    """Create the Discord bot used by the bridge.
+
+    With ``lazy_members``, the members intent is left off: the members of
+    every guild aren't sent to us on startup, and are only fetched when
+    they're needed.
+    """
+    intents = Intents.default()
+
+    # members intent is required to resolve discord.User/discord.Member
+    # on command parameters, unless they're fetched on demand
+    intents.members = not lazy_members
+    intents.typing = False
+
+    client = commands.Bot(
+        intents=intents,
+        command_prefix=commands.when_mentioned,
+        chunk_guilds_at_startup=not lazy_members,
+    )
+
+    async def report_startup():
+        client.remove_listener(report_startup, "on_ready")
+
+        elapsed = time.monotonic() - metrics.STARTED_AT
+        metrics.DISCORD_READY.set(elapsed)
+        log.info(
+            "discord is ready after %.2fs: %d guilds, %d users cached, "
+            "%.1f MiB max rss (lazy members: %s)",
+            elapsed,
+            len(client.guilds),
+            len(client.users),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "on" if lazy_members else "off",
+        )
+
+    client.add_listener(report_startup, "on_ready")
+    return client
+
+
 class Discord:
     """A wrapper around a Discord client that mirrors XMPP messages to a room's
     configured webhook.
     """
 
-    def __init__(self, *, config):
+    def __init__(self, *, config, router, config_file=None, tracer=None, media=None):
         self.config = config
-        intents = Intents.default()
+        self.router = router
+
+        #: The :class:`black_hole.tracing.Tracer` of messages to Discord.
+        self.tracer = tracer or Tracer(config)
 
-        # members intent is required to resolve discord.User/discord.Member
-        # on command parameters
-        intents.members = True
-        intents.typing = False
+        #: The :class:`black_hole.media.MediaRelay` that files are linked to
+        #: through, if any.
+        self.media = media
 
-        self.client = commands.Bot(
-            intents=intents, command_prefix=commands.when_mentioned
+        self.client = make_client(
+            lazy_members=self.config["discord"].get("lazy_members", False)
         )
-        self.client.add_cog(Management(self.client, self.config))
-        self.session = aiohttp.ClientSession(loop=self.client.loop)
+        self.client.add_cog(
+            Management(self.client, self.config, bridge=self, config_file=config_file)
+        )
+
+        # keeps track of username collisions in bridged channels
+        self.names = NameIndex(self.client)
 
-        self.client.loop.create_task(self._sender())
+        # cleans mentions out of messages going to xmpp
+        self.sanitizer = Sanitizer(self.client)
+        self.transport = WebhookTransport(
+            loop=self.client.loop, config=self.config["discord"].get("transport", {})
+        )
 
-        self._queue = []
-        self._incoming = asyncio.Event()
+        #: { str: Lane }
+        # every room gets its own lane of webhook jobs, keyed by the room's jid.
+        self._lanes = {}
 
-        #: { int: (timestamp, str) }
-        self._avatar_cache = {}
+        for room_config in self.router.rooms:
+            self.lane_for(room_config)
+
+        self.journal = None
+        journal_config = self.config["discord"].get("journal")
+        if journal_config is not None:
+            self.journal = Journal(
+                journal_config.get("path", "journal.sqlite3"),
+                loop=self.client.loop,
+                commit_interval=journal_config.get("commit_interval", 0.05),
+            )
+            self._replay_journal()
+
+        self.ratelimiter = RateLimiter()
+
+        # caps the number of webhook requests in flight across all lanes.
+        self.concurrency = asyncio.Semaphore(
+            self.config["discord"].get("concurrency", 8)
+        )
+
+        # the default is 30 minutes when not provided
+        self.avatars = AvatarCache(
+            self.client,
+            ttl=self.config["discord"].get("avatar_cache", 30 * 60),
+            max_size=self.config["discord"].get("avatar_cache_size", 1024),
+        )
+        self.client.add_listener(self._warm_avatars, "on_ready")
+
+        metrics.QUEUE_DEPTH.add_function(lambda: self._collect_lane_metrics("depth"))
+        metrics.QUEUE_DROPPED.add_function(
+            lambda: self._collect_lane_metrics("dropped")
+        )
+        metrics.AVATAR_CACHE_HITS.add_function(lambda: {(): self.avatars.hits})
+        metrics.AVATAR_CACHE_MISSES.add_function(lambda: {(): self.avatars.misses})
 
         #: { (jid, xmpp_message_id): discord_message_id }
-        # the message id store serves as a way for edited messages coming
+        # the message store serves as a way for edited messages coming
         # from a xmpp room to have the edit reflected on the discord channel.
         #
         # the high level overview is as follows:
@@ -64,63 +182,95 @@ class Discord:
         #   if so, issue a patch (since we have the webhook url AND message id)
         #   if not, issue a post, and store the message id for later
         #
-        # the store has a maximum of 1k messages, and lets an xmpp message
-        # be last corrected for an hour
-        self._message_id_store = ExpiringDict(max_len=1000, max_age_seconds=3600)
-
-    async def _get_from_cache(self, user_id: int) -> Optional[str]:
-        """Get an avatar in cache."""
-
-        # if we insert anything into the cache, invalidation_ts
-        # represents when that value will become invalidated.
-
-        # it uses time.monotonic() because the monotonic clock
-        # is way more stable than the general clock.
-        current = time.monotonic()
-
-        # the default is 30 minutes when not provided
-        cache_period = self.config["discord"].get("avatar_cache", 80 * 60)
-
-        invalidation_ts = current + cache_period
-
-        value = self._avatar_cache.get(user_id)
+        # the store keeps a configurable amount of messages in memory (and
+        # optionally on disk), and lets an xmpp message be last corrected for
+        # a configurable amount of time.
+        #
+        # when messages are coalesced, it also keeps track of which line of
+        # the discord message came from which xmpp message, so that correcting
+        # one of them can PATCH the whole discord message.
+        store_config = self.config["discord"].get("message_store", {})
+        self.messages = MessageStore(
+            loop=self.client.loop,
+            max_entries=store_config.get("max_entries", 10000),
+            max_age=store_config.get("max_age", 24 * 60 * 60),
+            path=store_config.get("path"),
+            commit_interval=store_config.get("commit_interval", 0.5),
+        )
+        metrics.MESSAGE_STORE_HITS.add_function(lambda: {(): self.messages.hits})
+        metrics.MESSAGE_STORE_MISSES.add_function(lambda: {(): self.messages.misses})
+
+    def _replay_journal(self):
+        """Queue up every job that wasn't delivered before we last exited."""
+        # the journal holds every undelivered job, including spilled ones, so
+        # spill files are redundant and would only duplicate jobs.
+        for lane in self._lanes.values():
+            if lane._spill is not None:
+                lane._spill.clear()
+
+        max_age = self.config["discord"]["journal"].get("max_age", 60 * 60)
+        now = time.time()
+
+        replayed = 0
+        for journal_id, key, job in self.journal.replay():
+            lane = self._lanes.get(key)
+            if lane is None:
+                # the room doesn't exist anymore
+                self.journal.ack(journal_id)
+                continue
 
-        if value is None:
-            # try get_user_info, which has a 1/1 ratelimit.
-            # since it has that low of a ratelimit we cache
-            # the resulting avatar url internally for 30 minutes.
-            user = await self.client.fetch_user(user_id)
+            if now - job.get("received_at", now) > max_age:
+                # the conversation has moved on since
+                self.journal.ack(journal_id)
+                continue
 
-            # user not found, write that in cache so we don't need
-            # to keep checking later on.
-            if user is None:
-                self._avatar_cache[user_id] = (invalidation_ts, None)
-                return None
+            job["journal_ids"] = [journal_id]
+            lane.push(job)
+            replayed += 1
 
-            # user found, store its avatar url in cache and return it
-            avatar_url = str(user.avatar_url_as(format="png"))
-            self._avatar_cache[user_id] = (invalidation_ts, avatar_url)
-            return avatar_url
+        if replayed:
+            log.info("replaying %d jobs from the journal", replayed)
 
-        user_ts, avatar_url = value
+    def ack(self, job):
+        """Acknowledge a job as delivered (or dropped), removing it from the
+        journal.
+        """
+        if self.journal is not None and job.get("journal_ids"):
+            self.journal.ack(*job["journal_ids"])
 
-        # if the user cache value is invalid,
-        # we recall _get_from_cache with the given user id deleted
-        # so that it calls get_user_info and writes the new data
-        # to cache.
-        if current > user_ts:
-            self._avatar_cache.pop(user_id)
-            return await self._get_from_cache(user_id)
+    def _mapped_user_id(self, jid: str) -> Optional[int]:
+        mappings = self.config["discord"].get("jid_map", {})
+        return mappings.get(jid)
 
-        return avatar_url
+    async def _warm_avatars(self):
+        """Fetch the avatars of every mapped user that isn't in the client's
+        cache, so the first message of each of them doesn't have to.
+        """
+        user_ids = [
+            user_id
+            for user_id in self.config["discord"].get("jid_map", {}).values()
+            if self.client.get_user(user_id) is None
+        ]
+
+        if user_ids:
+            log.info("warming avatar cache with %d users", len(user_ids))
+            await self.avatars.warm(user_ids)
+
+    def prefetch_avatar(self, jid: str):
+        """Start resolving the avatar of a JID in the background, so it's ready
+        by the time its message is sent.
+        """
+        user_id = self._mapped_user_id(jid)
+        if user_id is not None and self.client.get_user(user_id) is None:
+            self.avatars.prefetch(user_id)
 
-    async def resolve_avatar(self, member) -> Optional[str]:
-        """Resolve an avatar url, given a XMPP member.
+    async def resolve_avatar(self, jid: str) -> Optional[str]:
+        """Resolve an avatar url, given the JID of a XMPP member.
 
-        This caches the given avatar url for a set period of time.
+        Avatars of users that aren't in the client's cache are cached for a set
+        period of time.
         """
-        mappings = self.config["discord"].get("jid_map", {})
-        user_id = mappings.get(str(member.direct_jid))
+        user_id = self._mapped_user_id(jid)
 
         # if nothing on the map, there isn't a need
         # to check our caches
@@ -135,118 +285,351 @@ class Discord:
         if user is not None:
             return str(user.avatar_url_as(format="png"))
 
-        return await self._get_from_cache(user_id)
+        return await self.avatars.get(user_id)
 
-    async def bridge(self, room, msg, member, source):
+    async def bridge(self, room, msg, member, source, *, received_at=None, trace=None):
         """Add a MUC message to the queue to be processed."""
         content = msg.body.any()
 
+        if self.media is not None:
+            content = self.media.rewrite(content)
+
         if len(content) > 1900:
             content = content[:1900] + "... (trimmed)"
 
         payload = {
             "username": ensure_valid_nick(member.nick),
             "content": clean_content(content),
-            "avatar_url": await self.resolve_avatar(member),
+            # resolved right before sending, see send_job
+            "avatar_url": None,
         }
 
-        log.debug("adding message to queue")
+        if trace is not None:
+            trace.mark("cleaned")
+
+        author_jid = str(member.direct_jid)
+        self.prefetch_avatar(author_jid)
+
+        log.debug("adding message to lane")
 
         # incoming messages that aren't edits have the attribute set to None
         original_xmpp_message_id = (
             None if msg.xep0308_replace is None else msg.xep0308_replace.id_
         )
 
-        # add this message to the queue (processed later by _send_all)
-        self._queue.append(
-            {
-                "author_jid": str(member.direct_jid),
-                "xmpp_message_id": msg.id_,
-                "original_xmpp_message_id": original_xmpp_message_id,
-                "webhook_url": room.config["webhook"],
-                "payload": payload,
-            }
-        )
+        job = {
+            "author_jid": author_jid,
+            "xmpp_message_id": msg.id_,
+            "original_xmpp_message_id": original_xmpp_message_id,
+            "webhook_url": room.config.webhook,
+            "payload": payload,
+            "queued_at": time.monotonic(),
+            "received_at": received_at or time.time(),
+            "room": room.jid,
+            "journal_ids": [],
+        }
+
+        if self.journal is not None:
+            job["journal_ids"].append(self.journal.record(room.jid, job))
+
+        if trace is not None:
+            job["trace_id"] = trace.id
+
+        # add this message to the room's lane (processed later by send_job)
+        self.lane_for(room.config).push(job)
+
+        if trace is not None:
+            trace.mark("queued")
+
+    def lane_for(self, room_config) -> Lane:
+        """Get the lane of a room, creating it if needed."""
+        key = room_config.jid
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = Lane(self, key, config=room_config.raw)
+        return lane
+
+    def reconfigure_lanes(self):
+        """Apply changes to the configuration to existing lanes."""
+        for key, lane in self._lanes.items():
+            room_config = self.router.by_jid(key)
+            if room_config is not None:
+                lane.reconfigure(room_config.raw)
+
+    def _pick_webhook(self, job) -> str:
+        """Pick the webhook to post a job with, out of its room's webhooks.
+
+        Jobs of a lane are sent one after another, so the room's messages stay
+        in order whichever webhook posts them. The first webhook that isn't
+        rate limited (or failing) is picked, or else the one that frees up the
+        soonest.
+        """
+        room = self.router.by_jid(job.get("room"))
+        if room is None or len(room.webhooks) == 1:
+            return job["webhook_url"]
 
-        self._incoming.set()
+        def cost(webhook_url):
+            breaker = self.transport.breaker(webhook_url)
+            return (
+                breaker.dead,
+                breaker.open,
+                self.ratelimiter.bucket("POST", webhook_url).delay(),
+            )
 
-    async def _send_all(self):
-        """Send all pending webhook messages."""
-        log.debug("working on %d jobs...", len(self._queue))
-        for job in self._queue:
-            xmpp_message_id: Optional[str] = job["xmpp_message_id"]
-            original_xmpp_message_id: Optional[str] = job["original_xmpp_message_id"]
+        return min(room.webhooks, key=cost)
 
-            # key used to write to the store
-            store_key = (job["author_jid"], xmpp_message_id)
+    async def send_job(self, job):
+        """Send a single webhook job.
 
-            # key used to lookup the message (as the replace message has a different id,
-            # using original_xmpp_message_id directly would always yield non-hits to the
-            # message id store)
-            lookup_key = (job["author_jid"], original_xmpp_message_id)
-            webhook_url = job["webhook_url"]
-            resp = None
+        The job is retried when we get rate limited or when Discord has
+        trouble on its end (5xx).
+        """
+        trace = self.tracer.get(job.get("trace_id"))
+        if trace is None:
+            await self._send_job(job)
+            return
+
+        trace.mark("dequeued")
+        try:
+            await self._send_job(job, trace)
+        finally:
+            self.tracer.finish(trace)
+
+    async def _send_job(self, job, trace=None):
+        xmpp_message_id: Optional[str] = job["xmpp_message_id"]
+        original_xmpp_message_id: Optional[str] = job["original_xmpp_message_id"]
+
+        author_jid: str = job["author_jid"]
+        webhook_url = job["webhook_url"]
+        payload = job["payload"]
+        segments = job.get("segments")
+
+        # avatars are resolved as late as possible, so a cold cache doesn't
+        # hold up bridging (the avatar is usually prefetched by now)
+        if payload["avatar_url"] is None:
+            try:
+                avatar_url = await self.resolve_avatar(job["author_jid"])
+            except Exception:
+                log.exception("failed to resolve avatar of %s", job["author_jid"])
+                avatar_url = None
+
+            payload = {**payload, "avatar_url": avatar_url}
+
+        if trace is not None:
+            trace.mark("avatar")
+
+        # look up the message being corrected (as the replace message has a
+        # different id, looking up xmpp_message_id would always yield non-hits
+        # to the message store). by checking if original id is none or not
+        # beforehand, we prevent unecessary lookups in the message store
+        original = None
+        if original_xmpp_message_id is not None:
+            original = await self.messages.get(author_jid, original_xmpp_message_id)
+
+        if original is not None:
+            # messages can only be edited by the webhook that posted them
+            discord_message_id, webhook_url = original[0], original[1] or webhook_url
+            method, url = "PATCH", f"{webhook_url}/messages/{discord_message_id}"
+
+            segments = await self.messages.get_segments(discord_message_id)
+            if segments is not None:
+                # the corrected message was coalesced with others, so only
+                # replace its own line
+                payload = {
+                    **payload,
+                    "content": correct_segments(
+                        segments,
+                        original_xmpp_message_id,
+                        xmpp_message_id,
+                        payload["content"],
+                    ),
+                }
+        else:
+            webhook_url = self._pick_webhook(job)
+            method, url = "POST", webhook_url
+
+        breaker = self.transport.breaker(webhook_url)
+        while not breaker.allow():
+            if breaker.dead:
+                # there's no point in keeping jobs for deleted webhooks
+                metrics.WEBHOOK_SKIPPED.inc()
+                self.ack(job)
+                return
+
+            # the webhook is merely failing: hold the lane (so the room's
+            # messages stay in order) until it can be tried again, unless
+            # another webhook of the room can post the job in the meantime
+            await asyncio.sleep(max(breaker.retry_after(), 0.05))
+            if method == "POST":
+                webhook_url = url = self._pick_webhook(job)
+                breaker = self.transport.breaker(webhook_url)
+
+        retries = self.config["discord"].get("retries", 5)
+        body = dumps(payload)
+
+        for attempt in range(retries + 1):
+            # edits are in the webhook's bucket rather than the message's, and
+            # the bucket may have been merged with another one since
+            bucket = self.ratelimiter.bucket(method, webhook_url)
+            await self.ratelimiter.acquire(bucket)
 
             try:
-                # by checking if original id is none or not beforehand, we
-                # prevent unecessary lookups in the message store
-                if (
-                    original_xmpp_message_id is not None
-                    and lookup_key in self._message_id_store
-                ):
-                    discord_message_id = self._message_id_store[lookup_key]
-                    resp = await self.session.patch(
-                        f"{webhook_url}/messages/{discord_message_id}",
-                        json=job["payload"],
-                        params={"wait": "true"},
-                    )
-                else:
-                    resp = await self.session.post(
-                        webhook_url, json=job["payload"], params={"wait": "true"}
+                async with self.concurrency:
+                    async with self.transport.request(method, url, body) as resp:
+                        if trace is not None:
+                            trace.mark("http")
+
+                        retry_after = self.ratelimiter.update(bucket, resp)
+                        metrics.WEBHOOK_RESPONSES.inc(status=resp.status)
+
+                        if resp.status == 200:
+                            discord_message = await resp.json()
+                            message_id = discord_message["id"]
+                            if xmpp_message_id is not None:
+                                self.messages.put(
+                                    author_jid, xmpp_message_id, message_id, webhook_url
+                                )
+                            if segments is not None:
+                                self._store_segments(
+                                    job, message_id, segments, webhook_url
+                                )
+                            breaker.succeeded()
+                            self.ack(job)
+                            self._observe_delivery(job)
+                            return
+
+                        try:
+                            response_body = await resp.read()
+                        except Exception:
+                            response_body = b""
+            except Exception as error:
+                if attempt < retries and is_retriable(method, error):
+                    delay = backoff(attempt)
+                    log.warning(
+                        "failed to send to webhook (%r), retrying in %.2fs",
+                        error,
+                        delay,
                     )
-            except Exception:
+                    await asyncio.sleep(delay)
+                    continue
+
                 log.exception("failed to bridge content")
+                breaker.failed()
+
+                # we can't tell if the message went through, so we give up on
+                # the job (replaying it later could post it twice), and go to
+                # the next one.
+                self.ack(job)
+                return
+
+            if retry_after is not None:
+                # the bucket (or the global limit) is now blocked for
+                # retry_after seconds, acquire() will wait it out for us.
+                log.warning(
+                    "rate limited on %s %s, retrying in %.2fs", method, url, retry_after
+                )
+                continue
 
-                # if we failed to bridge for any reason (not just the network)
-                # on this piece of code (even though the network is the most
-                # likely cause), we skip the job, and go to the next one.
+            if resp.status >= 500 and attempt < retries:
+                delay = backoff(attempt)
+                log.warning(
+                    "discord returned %d, retrying in %.2fs", resp.status, delay
+                )
+                await asyncio.sleep(delay)
                 continue
 
-            assert resp is not None
-            await asyncio.sleep(self.config["discord"].get("delay", 0.25))
+            # by using wait=true, we basically force discord to always
+            # give us 200. this means 204's are considered an error
+            # condition
+            break
+
+        log.warning(
+            "failed to bridge xmpp -> discord. status=%d, body=%r, payload=%r",
+            resp.status,
+            response_body,
+            payload,
+        )
+
+        if resp.status >= 500:
+            breaker.failed()
+        elif is_dead_webhook(resp.status, response_body):
+            breaker.failed(dead=True)
+
+        # we gave up on the job, so don't replay it later on, where it would
+        # end up out of order
+        self.ack(job)
+
+    def _observe_delivery(self, job):
+        count = len(job["segments"]) if "segments" in job else 1
+        metrics.MESSAGES.inc(count, room=job.get("room"), direction="to_discord")
+        metrics.observe_first_message("to_discord")
+
+        received_at = job.get("received_at")
+        if received_at is not None:
+            metrics.LATENCY.observe(time.time() - received_at, direction="to_discord")
+
+    def _collect_lane_metrics(self, attribute: str):
+        return {
+            (key, "to_discord"): getattr(lane, attribute)
+            for key, lane in self._lanes.items()
+        }
+
+    def _store_segments(self, job, message_id, segments, webhook_url):
+        """Remember which xmpp messages a coalesced discord message is made of."""
+        self.messages.put_segments(message_id, segments)
 
-            if resp.status == 200:
-                discord_message = await resp.json()
+        for segment in segments:
+            for xmpp_message_id in segment["ids"]:
                 if xmpp_message_id is not None:
-                    self._message_id_store[store_key] = discord_message["id"]
-            else:
-                # by using wait=true, we basically force discord to always
-                # give us 200. this means 204's are considered an error
-                # condition
+                    self.messages.put(
+                        job["author_jid"], xmpp_message_id, message_id, webhook_url
+                    )
+
+    async def drain(self):
+        """Wait until every lane has been sent."""
+        await asyncio.gather(*(lane.drain() for lane in self._lanes.values()))
 
+    @property
+    def pending(self) -> int:
+        """The amount of jobs waiting to be sent."""
+        return sum(lane.depth for lane in self._lanes.values())
+
+    async def close(self):
+        """Stop sending jobs, save everything to disk, and log out.
+
+        Jobs that haven't been sent are kept in the journal (if configured), and
+        sent on the next startup.
+        """
+        for lane in self._lanes.values():
+            lane._task.cancel()
+
+        for lane in self._lanes.values():
+            if lane._spill is not None:
                 try:
-                    body = await resp.read()
-                except Exception:
-                    body = "<none>"
+                    await lane._spill.flush()
+                except OSError:
+                    log.exception("[%s] failed to write spilled jobs", lane.key)
 
-                log.warning(
-                    "failed to bridge discord -> xmpp. status=%d, body=%r, payload=%r",
-                    resp.status,
-                    body,
-                    job["payload"],
-                )
+        if self.journal is not None:
+            await self.journal.flush()
+            self.journal.close()
 
-        self._queue.clear()
-        self._incoming.clear()
+        await self.messages.flush()
+        self.messages.close()
 
-    async def _sender(self):
-        while True:
-            log.debug("waiting for messages...")
-            await self._incoming.wait()
+        await self.transport.close()
+        await self.client.logout()
 
-            log.debug("emptying queue")
-            await self._send_all()
+    async def boot(self, *, gateway: bool = True):
+        """Log into Discord and connect to the gateway.
+
+        Without the gateway, no events are received, but the API (which is all
+        that's needed for sending to webhooks) can still be used.
+        """
+        if not gateway:
+            log.info("logging into discord...")
+            await self.client.login(self.config["discord"]["token"])
+            return
 
-    async def boot(self):
         log.info("connecting to discord...")
         await self.client.start(self.config["discord"]["token"])
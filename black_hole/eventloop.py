@@ -0,0 +1,45 @@
+"""This module picks the event loop implementation the bridge runs on.
+
+The ``loop`` option of the configuration can be ``asyncio`` (the default) or
+``uvloop``, which cuts down the overhead of the event loop itself. uvloop is
+an optional dependency: if it isn't installed, the default loop is used.
+"""
+
+__all__ = ["install"]
+
+import asyncio
+import logging
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+log = logging.getLogger(__name__)
+
+#: The event loop implementations that can be picked.
+IMPLEMENTATIONS = ("asyncio", "uvloop")
+
+
+def install(name: str = "asyncio") -> str:
+    """Use an event loop implementation for every loop created from now on.
+
+    This has to be called before the loop is created. Returns the name of the
+    implementation that is actually used.
+    """
+    if name not in IMPLEMENTATIONS:
+        log.warning("unknown event loop %r, using asyncio", name)
+        return "asyncio"
+
+    if name == "uvloop":
+        if uvloop is None:
+            log.warning("uvloop isn't installed, using asyncio")
+            return "asyncio"
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        # uvloop doesn't create a loop on demand, but everything expects
+        # asyncio.get_event_loop() to
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    return name
@@ -0,0 +1,71 @@
+"""This module implements a durable journal of outbound webhook jobs.
+
+Every job is written to the journal when it's queued, and removed from it once
+it has been delivered. Jobs left in the journal when the process exits (or
+crashes) are replayed in order on the next startup.
+
+Writes are batched (see :class:`black_hole.database.Database`), so journaling
+costs one commit per batch instead of one per message.
+"""
+
+__all__ = ["Journal"]
+
+import json
+import logging
+
+from .database import Database
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    lane TEXT NOT NULL,
+    job TEXT NOT NULL
+);
+"""
+
+
+class Journal:
+    """A write-ahead journal of webhook jobs, backed by SQLite."""
+
+    def __init__(self, path: str, *, loop, commit_interval: float = 0.05):
+        self.db = Database(
+            path, loop=loop, schema=SCHEMA, commit_interval=commit_interval
+        )
+
+        ((last_id,),) = self.db.query("SELECT MAX(id) FROM jobs")
+        self._next_id = (last_id or 0) + 1
+
+    def replay(self):
+        """Get every job that was never acknowledged, oldest first.
+
+        Yields ``(journal_id, lane, job)`` tuples. This should only be called on
+        startup, before anything is recorded.
+        """
+        rows = self.db.query("SELECT id, lane, job FROM jobs ORDER BY id")
+        for journal_id, lane, job in rows:
+            yield journal_id, lane, json.loads(job)
+
+    def record(self, lane: str, job) -> int:
+        """Record a job in the journal, returning its id."""
+        journal_id = self._next_id
+        self._next_id += 1
+
+        self.db.write(
+            "INSERT INTO jobs (id, lane, job) VALUES (?, ?, ?)",
+            (journal_id, lane, json.dumps(job)),
+        )
+        return journal_id
+
+    def ack(self, *journal_ids: int):
+        """Remove delivered (or deliberately dropped) jobs from the journal."""
+        for journal_id in journal_ids:
+            self.db.write("DELETE FROM jobs WHERE id = ?", (journal_id,))
+
+    async def flush(self):
+        """Commit every pending write."""
+        await self.db.flush()
+
+    def close(self):
+        self.db.close()
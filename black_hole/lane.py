@@ -0,0 +1,304 @@
+__all__ = ["Lane"]
+
+import asyncio
+import collections
+import itertools
+import logging
+import math
+import time
+
+from .spill import SpillFile
+
+log = logging.getLogger(__name__)
+
+#: The maximum length of a Discord message.
+MAX_CONTENT_LENGTH = 2000
+
+#: What a lane can do with new jobs once it's full.
+OVERLOAD_POLICIES = ("drop-oldest", "coalesce", "spill")
+
+
+def can_merge(first, job, window: float) -> bool:
+    """Check if a job can be coalesced into a (possibly already coalesced) job
+    that was queued before it.
+    """
+    # corrections need to be sent on their own, so they can be PATCHed
+    if (
+        first["original_xmpp_message_id"] is not None
+        or job["original_xmpp_message_id"] is not None
+    ):
+        return False
+
+    if job["queued_at"] - first["queued_at"] > window:
+        return False
+
+    if (
+        first["author_jid"] != job["author_jid"]
+        or first["webhook_url"] != job["webhook_url"]
+        or first["payload"]["username"] != job["payload"]["username"]
+        or first["payload"]["avatar_url"] != job["payload"]["avatar_url"]
+    ):
+        return False
+
+    length = len(first["payload"]["content"]) + 1 + len(job["payload"]["content"])
+    return length <= MAX_CONTENT_LENGTH
+
+
+def merge(first, job):
+    """Coalesce a job into another one, returning the merged job.
+
+    The merged job keeps track of the XMPP message each line of its content
+    came from, so corrections to any of them can be reflected later on.
+    """
+    segments = first.get("segments")
+    if segments is None:
+        segments = [
+            {"ids": [first["xmpp_message_id"]], "content": first["payload"]["content"]}
+        ]
+
+    segments = segments + [
+        {"ids": [job["xmpp_message_id"]], "content": job["payload"]["content"]}
+    ]
+
+    return {
+        **first,
+        "payload": {
+            **first["payload"],
+            "content": "\n".join(segment["content"] for segment in segments),
+        },
+        "segments": segments,
+        "journal_ids": first.get("journal_ids", []) + job.get("journal_ids", []),
+    }
+
+
+class Lane:
+    """An ordered queue of webhook jobs belonging to a single room.
+
+    Every room gets its own lane with its own consumer, so a flood in one room
+    doesn't hold up any other room. Jobs within a lane are always sent one
+    after another, in the order they were pushed.
+
+    A lane holds a bounded amount of jobs. Once it's full, its overload policy
+    decides what happens to new jobs:
+
+    - ``drop-oldest`` drops the oldest job in the lane.
+    - ``coalesce`` merges the new job (or two older ones) with another job
+      from the same author, falling back to dropping the oldest job.
+    - ``spill`` writes new jobs to disk until the lane has drained.
+    """
+
+    def __init__(self, discord, key, *, config):
+        self.discord = discord
+        self.key = key
+
+        self._spill = None
+        self.reconfigure(config)
+
+        #: The amount of jobs dropped because the lane was full.
+        self.dropped = 0
+
+        #: The amount of jobs merged into others because the lane was full.
+        self.coalesced = 0
+
+        #: The amount of jobs written to disk because the lane was full.
+        self.spilled = 0
+
+        self._overloaded = False
+        self._queue = collections.deque()
+        self._incoming = asyncio.Event()
+        self._task = discord.client.loop.create_task(self._sender())
+
+        if self._spill is not None and self._spill.pending:
+            log.info("[%s] resuming %d spilled jobs", key, self._spill.pending)
+            self._incoming.set()
+
+    def reconfigure(self, config):
+        """Apply the queue options of the room's configuration."""
+        queue_config = config.get("queue", {})
+        self.size = queue_config.get("size", 1000)
+        self.policy = queue_config.get("policy", "drop-oldest")
+
+        if self.policy not in OVERLOAD_POLICIES:
+            log.warning(
+                "[%s] unknown overload policy %r, using drop-oldest",
+                self.key,
+                self.policy,
+            )
+            self.policy = "drop-oldest"
+
+        if self.policy == "spill":
+            if self._spill is None:
+                self._spill = SpillFile(
+                    queue_config.get("spill_dir", "spill"),
+                    self.key,
+                    loop=self.discord.client.loop,
+                )
+        elif self._spill is not None and not self._spill.pending:
+            # jobs that were already spilled are still sent first
+            self._spill = None
+
+    def __len__(self):
+        return self.depth
+
+    @property
+    def depth(self) -> int:
+        """The amount of jobs waiting to be sent, including spilled jobs."""
+        spilled = 0 if self._spill is None else self._spill.pending
+        return len(self._queue) + spilled
+
+    def push(self, job):
+        """Add a job to the end of the lane."""
+        if self._spill is not None and self._spill.pending:
+            # once jobs have been spilled, everything after them has to be
+            # spilled as well to keep them in order.
+            self._spill.append(job)
+            self.spilled += 1
+        elif len(self._queue) >= self.size:
+            self._overflow(job)
+        else:
+            self._overloaded = False
+            self._queue.append(job)
+
+        self._incoming.set()
+
+    def _overflow(self, job):
+        """Apply the overload policy to a job that doesn't fit in the lane."""
+        if not self._overloaded:
+            log.warning(
+                "[%s] lane is full (%d jobs), applying policy %s",
+                self.key,
+                self.size,
+                self.policy,
+            )
+            self._overloaded = True
+
+        if self.policy == "spill":
+            self._spill.append(job)
+            self.spilled += 1
+            return
+
+        if self.policy == "coalesce" and self._coalesce_overflow(job):
+            self.coalesced += 1
+            return
+
+        self.discord.ack(self._queue.popleft())
+        self._queue.append(job)
+        self.dropped += 1
+
+    def _coalesce_overflow(self, job) -> bool:
+        """Make room for a job by merging it, or two older jobs, together.
+
+        Returns whether room could be made.
+        """
+        if can_merge(self._queue[-1], job, math.inf):
+            self._queue[-1] = merge(self._queue[-1], job)
+            return True
+
+        for index in range(len(self._queue) - 1):
+            first, second = self._queue[index], self._queue[index + 1]
+            if can_merge(first, second, math.inf):
+                self._queue[index] = merge(first, second)
+                del self._queue[index + 1]
+                self._queue.append(job)
+                return True
+
+        return False
+
+    @property
+    def coalesce_window(self) -> float:
+        return self.discord.config["discord"].get("coalesce", 0)
+
+    async def _wait_for_burst(self):
+        """Hold back the job at the head of the lane until the coalescing
+        window has passed, unless nothing else could be merged into it anyway.
+        """
+        window = self.coalesce_window
+        head = self._queue[0]
+
+        for job in itertools.islice(self._queue, 1, None):
+            if not can_merge(head, job, window):
+                return
+
+        # jobs read back from a spill file may come from a previous process,
+        # so the delay is clamped to the window.
+        delay = min(head["queued_at"] + window - time.monotonic(), window)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _take(self):
+        """Pop the next job off the lane, coalescing consecutive jobs into it
+        if enabled.
+        """
+        window = self.coalesce_window
+        job = self._queue.popleft()
+
+        if not window:
+            return job
+
+        while self._queue and can_merge(job, self._queue[0], window):
+            job = merge(job, self._queue.popleft())
+
+        if "segments" in job:
+            log.debug("[%s] coalesced %d jobs", self.key, len(job["segments"]))
+
+        return job
+
+    async def _send_all(self):
+        """Send all pending jobs in this lane."""
+        log.debug("[%s] working on %d jobs...", self.key, self.depth)
+        while self.depth:
+            if not self._queue:
+                try:
+                    self._queue.extend(await self._spill.read(self.size))
+                except OSError:
+                    # spilled jobs go first to keep the order, so there's
+                    # nothing to do but try again
+                    log.exception("[%s] failed to read spilled jobs", self.key)
+                    await asyncio.sleep(1)
+                    continue
+
+                if not self._queue:
+                    continue
+
+            if self.coalesce_window:
+                await self._wait_for_burst()
+
+            job = self._take()
+            try:
+                await self.discord.send_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # give up on the job, replaying it on the next startup would
+                # send it out of order
+                log.exception("[%s] failed to send a job", self.key)
+                self.discord.ack(job)
+
+            # rate limits are handled by send_job, but an extra delay between
+            # sends can still be configured.
+            delay = self.discord.config["discord"].get("delay", 0)
+            if delay:
+                await asyncio.sleep(delay)
+
+        self._incoming.clear()
+
+    async def drain(self):
+        """Wait until every job in the lane has been sent."""
+        # the event stays set until the sender has gone through every job
+        while self.depth or self._incoming.is_set():
+            await asyncio.sleep(0.05)
+
+    async def _sender(self):
+        while True:
+            log.debug("[%s] waiting for messages...", self.key)
+            await self._incoming.wait()
+
+            log.debug("[%s] emptying lane", self.key)
+            try:
+                await self._send_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # a lane that stops sending would never bridge its room again
+                log.exception("[%s] failed to empty lane", self.key)
+                await asyncio.sleep(1)
@@ -1,13 +1,18 @@
 """This module exposes a Cog that can be added to Discord.py bots.
 
-It allows management of the JID map.
+It allows management of the JID map and rooms, and inspection of the bridge.
 """
 
-__all__ = ["Management"]
+__all__ = ["Management", "LazyMember"]
+
+import asyncio
+import io
+import re
 
 import discord
 from discord.ext import commands
-from ruamel.yaml import YAML
+
+from .tracing import all_tasks, measure_loop_lag, profile_loop, summarize_tasks
 
 
 def managers_only():
@@ -17,16 +22,47 @@ def managers_only():
     return commands.check(predicate)
 
 
+class LazyMember(commands.MemberConverter):
+    """Converts to a :class:`discord.Member`, fetching members by ID or mention
+    over HTTP if they can't be found otherwise.
+
+    Without the members intent, members usually aren't cached, and querying
+    them over the gateway may not be allowed.
+    """
+
+    async def convert(self, ctx, argument):
+        try:
+            return await super().convert(ctx, argument)
+        except (commands.MemberNotFound, asyncio.TimeoutError):
+            match = self._get_id_match(argument) or re.match(
+                r"<@!?([0-9]+)>$", argument
+            )
+            if match is None or ctx.guild is None:
+                raise commands.MemberNotFound(argument) from None
+
+        try:
+            return await ctx.guild.fetch_member(int(match.group(1)))
+        except discord.HTTPException:
+            raise commands.MemberNotFound(argument) from None
+
+
 class Management(commands.Cog):
-    def __init__(self, bot, config):
+    def __init__(self, bot, config, *, bridge=None, config_file=None):
         self.bot = bot
         self.config = config
 
+        #: The :class:`black_hole.discord.Discord` instance we belong to.
+        self.bridge = bridge
+
+        #: The :class:`black_hole.config.ConfigFile` changes are saved to.
+        self.config_file = config_file
+
     def save_config(self):
-        yaml = YAML(typ="safe")
-        yaml.default_flow_style = False
-        with open("config.yaml", "w") as fp:
-            yaml.dump(self.config, fp)
+        if self.config_file is None:
+            return
+
+        # this returns immediately, the file is written in the background
+        self.config_file.save()
 
     @commands.group(name="rooms", aliases=["room"])
     @managers_only()
@@ -36,24 +72,79 @@ class Management(commands.Cog):
     @rooms_group.command(name="toggle")
     async def rooms_toggle(self, ctx, room_jid=None):
         """Toggles a room from being bridged both ways."""
-        if not room_jid and ctx.guild:
-            room_jid = discord.utils.find(
-                lambda room: room["channel_id"] == ctx.channel.id, self.config["rooms"]
-            )["jid"]
+        router = self.bridge.router
 
-        room = discord.utils.find(
-            lambda room: room["jid"] == room_jid, self.config["rooms"]
-        )
+        if not room_jid and ctx.guild:
+            room = router.by_channel(ctx.channel.id)
+        else:
+            room = router.by_jid(room_jid)
 
         if not room:
             await ctx.send("MUC not found.")
             return
 
-        room["disabled"] = not room.get("disabled", False)
-        state = "Disabled" if room["disabled"] else "Enabled"
-        await ctx.send(f"\N{CRAB} {state} bridging to and from {room_jid}.")
+        room.raw["disabled"] = not room.disabled
+        router.rebuild()
+
+        state = "Disabled" if room.raw["disabled"] else "Enabled"
+        await ctx.send(f"\N{CRAB} {state} bridging to and from {room.jid}.")
         self.save_config()
 
+    @commands.command(name="queues")
+    @managers_only()
+    async def queues(self, ctx):
+        """Show the state of every room's webhook queue."""
+        if self.bridge is None or not self.bridge._lanes:
+            await ctx.send("No queues.")
+            return
+
+        lines = [
+            f"{key}: {lane.depth} queued, {lane.dropped} dropped, "
+            f"{lane.coalesced} coalesced, {lane.spilled} spilled ({lane.policy})"
+            for key, lane in self.bridge._lanes.items()
+        ]
+        await ctx.send("\n".join(lines)[:2000])
+
+    @commands.group(name="debug", invoke_without_command=True)
+    @managers_only()
+    async def debug_group(self, ctx):
+        """Show the event loop's lag, running tasks and recent slow messages."""
+        lag = await measure_loop_lag()
+        tasks = all_tasks()
+
+        lines = [f"event loop lag: {lag * 1000:.1f}ms", f"{len(tasks)} tasks:"]
+        lines += [f"  {count} {name}" for name, count in summarize_tasks(tasks)[:15]]
+
+        tracer = getattr(self.bridge, "tracer", None)
+        if tracer is not None and tracer.slow:
+            lines.append("slow messages:")
+            lines += [f"  {trace.format()}" for trace in tracer.slow]
+
+        await ctx.send("```\n" + "\n".join(lines)[:1900] + "\n```")
+
+    @debug_group.command(name="profile")
+    async def debug_profile(self, ctx, seconds: float = 5):
+        """Sample what the bridge is doing for a few seconds."""
+        seconds = min(max(seconds, 0.1), 60)
+        await ctx.send(f"\N{STOPWATCH} Profiling for {seconds:g}s...")
+
+        own, total = await profile_loop(seconds)
+        samples = sum(own.values()) or 1
+
+        lines = [f"{samples} samples over {seconds:g}s", "", "top of the stack:"]
+        lines += [
+            f"{count / samples:6.1%}  {location}"
+            for location, count in own.most_common(20)
+        ]
+        lines += ["", "anywhere in the stack:"]
+        lines += [
+            f"{count / samples:6.1%}  {location}"
+            for location, count in total.most_common(40)
+        ]
+
+        report = io.BytesIO("\n".join(lines).encode())
+        await ctx.send(file=discord.File(report, filename="profile.txt"))
+
     @commands.group(name="jid")
     @managers_only()
     async def jid_group(self, ctx):
@@ -74,7 +165,7 @@ class Management(commands.Cog):
         await ctx.send(formatted)
 
     @jid_group.command(name="set", aliases=["add"])
-    async def jid_set(self, ctx, jid: commands.clean_content, member: discord.Member):
+    async def jid_set(self, ctx, jid: commands.clean_content, member: LazyMember):
         """Assign a JID to a Discord user."""
         self.config["discord"]["jid_map"][jid] = member.id
         self.save_config()
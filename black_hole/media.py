@@ -0,0 +1,494 @@
+"""This module relays media (attachments and uploaded files) across the bridge.
+
+Instead of linking to wherever a file was uploaded, bridged messages link to a
+local HTTP endpoint, which serves a copy of the file. Files are downloaded in
+the background as soon as they're linked to (Discord's CDN links expire), in
+chunks, so memory use doesn't depend on their size.
+
+Only files on the public internet are relayed: links that point to private,
+loopback or link-local addresses (or redirect to them) are left alone.
+
+Files are stored by the SHA-256 of their content, so a file that is posted
+several times (even from different URLs) is only stored once. Every URL that
+was linked to gets a small "link" file pointing to its content. Files that
+weren't requested for ``max_age`` seconds are evicted, as are the least
+recently requested ones once the store grows past ``max_size`` bytes.
+
+Everything lives in the filesystem, so several processes can share the same
+directory (see :mod:`black_hole.sharding`). Links are derived from the URL they
+stand for, so every process links a URL to the same place.
+
+The layout of the directory is::
+
+    objects/ab/abcdef...   the content of files, by their digest
+    links/0123....json     the URL, file name and digest of a link
+    tmp/                   downloads in progress
+"""
+
+__all__ = ["MediaRelay"]
+
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import mimetypes
+import os
+import re
+import socket
+import time
+import uuid
+from typing import Optional
+from urllib.parse import quote, unquote, urlsplit
+
+import aiohttp
+import aiohttp.abc
+import yarl
+from aiohttp import web
+
+from .metrics import MEDIA_EVICTED, MEDIA_FETCHED, MEDIA_REQUESTS, MEDIA_STORED
+from .store import LRU
+
+log = logging.getLogger(__name__)
+
+URL_RE = re.compile(r"https?://[^\s<>\"]+")
+
+#: Statuses of redirects, which are followed by hand so every hop is checked.
+REDIRECTS = (301, 302, 303, 307, 308)
+
+MAX_REDIRECTS = 5
+
+
+class Unrelayable(Exception):
+    """Raised when a file can't be relayed: it's too large, or it isn't on
+    the public internet.
+    """
+
+
+def is_public(address: str) -> bool:
+    """Check if an IP address is on the public internet, as opposed to a
+    private, loopback or link-local network (which includes cloud metadata
+    services).
+    """
+    try:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+    except ValueError:
+        return False
+
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicResolver(aiohttp.abc.AbstractResolver):
+    """Resolves hosts to their public addresses only, so that links can't be
+    used to reach the network the bridge runs in.
+    """
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = await self._resolver.resolve(host, port, family)
+        hosts = [resolved for resolved in hosts if is_public(resolved["host"])]
+        if not hosts:
+            raise OSError(f"{host} doesn't resolve to a public address")
+        return hosts
+
+    async def close(self):
+        await self._resolver.close()
+
+
+class MediaRelay:
+    """Downloads linked files into a content-addressed store, and serves them.
+
+    ``config`` is the ``media`` section of the configuration.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.loop = asyncio.get_event_loop()
+
+        self.path = config.get("path", "media")
+        self.host = config.get("host", "127.0.0.1")
+        self.port = config.get("port", 9101)
+
+        #: The URL the endpoint is reachable at from both sides of the bridge.
+        self.public_url = config.get(
+            "public_url", f"http://{self.host}:{self.port}/media"
+        ).rstrip("/")
+
+        self.max_size = config.get("max_size", 1024**3)
+        self.max_age = config.get("max_age", 7 * 24 * 60 * 60)
+        self.max_file_size = config.get("max_file_size", 25 * 1024**2)
+        self.chunk_size = config.get("chunk_size", 64 * 1024)
+
+        #: Hosts whose links in XMPP messages are relayed.
+        self.hosts = set(config.get("hosts", []))
+
+        for directory in ("objects", "links", "tmp"):
+            os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+
+        self._session = None
+        self._runner = None
+        self._evictor = None
+        self._slots = asyncio.Semaphore(config.get("concurrency", 4))
+
+        #: { str: dict }
+        # links we know of, so linking to a file never touches the disk.
+        # they're written to disk in the background, and read back from it
+        # when they were made by another process (or before a restart).
+        self._links = LRU(max_entries=10000, max_age=self.max_age)
+
+        #: { str: asyncio.Task }
+        # downloads in progress, by link key
+        self._inflight = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            timeout = aiohttp.ClientTimeout(
+                total=self.config.get("timeout", 60), connect=10
+            )
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(resolver=PublicResolver()),
+                timeout=timeout,
+            )
+        return self._session
+
+    def _run(self, function, *args):
+        """Run blocking file I/O in the background."""
+        return self.loop.run_in_executor(None, function, *args)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def _link_path(self, key: str) -> str:
+        return os.path.join(self.path, "links", key + ".json")
+
+    def _read_link(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._link_path(key), "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _write_link(self, key: str, link: dict):
+        # written to the side first, so other processes never see half of it
+        tmp_path = os.path.join(self.path, "tmp", uuid.uuid4().hex)
+        with open(tmp_path, "w") as fp:
+            json.dump(link, fp)
+        os.replace(tmp_path, self._link_path(key))
+
+    def _touch(self, path: str) -> bool:
+        """Mark a file as just requested, returning whether it exists."""
+        try:
+            # the modification time is when the file was last requested
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _requested(self, key: str, digest: Optional[str]) -> bool:
+        """Mark a link and its file as just requested, returning whether the
+        file is in the store.
+        """
+        self._touch(self._link_path(key))
+        return digest is not None and self._touch(self._object_path(digest))
+
+    def _store(self, tmp_path: str, digest: str):
+        """Move a downloaded file into the store."""
+        path = self._object_path(digest)
+        if self._touch(path):
+            # the same file was posted before
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def _get_link(self, key: str) -> Optional[dict]:
+        link = self._links.get(key)
+        if link is None:
+            link = await self._run(self._read_link, key)
+            if link is not None:
+                self._links.put(key, link)
+        return link
+
+    def link(self, url: str, name: Optional[str] = None, *, size=None) -> str:
+        """Get the relayed URL of a file, and start downloading it.
+
+        Returns ``url`` itself if the file is known not to be relayable.
+        """
+        if size is not None and size > self.max_file_size:
+            return url
+
+        if name is None:
+            name = unquote(urlsplit(url).path.rsplit("/", 1)[-1]) or "file"
+
+        key = hashlib.sha256(url.encode()).hexdigest()[:32]
+        link = self._links.get(key)
+        if link is None:
+            self._links.put(key, {"url": url, "name": name, "digest": None})
+            self._task_for(key)
+        elif link.get("unrelayable"):
+            return url
+        elif link["digest"] is None:
+            self._task_for(key)
+
+        return f"{self.public_url}/{key}/{quote(name)}"
+
+    def relayed(self, url: str) -> bool:
+        """Check if a link found in an XMPP message should be relayed."""
+        return urlsplit(url).hostname in self.hosts
+
+    def rewrite(self, content: str) -> str:
+        """Replace the links to files on ``hosts`` in an XMPP message with
+        relayed ones.
+        """
+
+        def replace(match):
+            url = match.group()
+            return self.link(url) if self.relayed(url) else url
+
+        return URL_RE.sub(replace, content)
+
+    def _task_for(self, key: str) -> asyncio.Task:
+        """Get the task downloading a link, starting one if there's none."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = self.loop.create_task(self._fetch(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda task: self._fetched(key, task))
+        return task
+
+    def _fetched(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+
+        if not task.cancelled() and task.exception() is not None:
+            log.error("failed to relay %s", key, exc_info=task.exception())
+
+    async def _get(self, url: str) -> aiohttp.ClientResponse:
+        """Start downloading a file, following redirects as long as they
+        stay on the public internet.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise Unrelayable(f"{url} isn't a http(s) url")
+
+            # the resolver only checks hosts that aren't addresses already
+            try:
+                ipaddress.ip_address(parts.hostname)
+            except ValueError:
+                pass
+            else:
+                if not is_public(parts.hostname):
+                    raise Unrelayable(f"{parts.hostname} isn't a public address")
+
+            resp = await self.session.get(url, allow_redirects=False)
+            if resp.status not in REDIRECTS or "Location" not in resp.headers:
+                return resp
+
+            url = str(resp.url.join(yarl.URL(resp.headers["Location"])))
+            resp.release()
+
+        raise Unrelayable("too many redirects")
+
+    async def _download(self, url: str, tmp_path: str) -> Optional[str]:
+        """Stream a file to ``tmp_path``, returning its digest, or ``None`` if
+        it couldn't be downloaded.
+        """
+        digest = hashlib.sha256()
+        size = 0
+
+        async with await self._get(url) as resp:
+            if resp.status != 200:
+                log.warning("failed to download %s: %d", url, resp.status)
+                return None
+
+            if (resp.content_length or 0) > self.max_file_size:
+                raise Unrelayable("it's too large")
+
+            fp = await self._run(open, tmp_path, "wb")
+            try:
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_file_size:
+                        raise Unrelayable("it's too large")
+
+                    digest.update(chunk)
+                    await self._run(fp.write, chunk)
+            finally:
+                await self._run(fp.close)
+
+        MEDIA_FETCHED.inc(size)
+        return digest.hexdigest()
+
+    async def _fetch(self, key: str) -> Optional[str]:
+        """Download the file of a link into the store, returning its digest."""
+        link = self._links.get(key)
+
+        # the link may have been made (and the file downloaded) by another
+        # process, or before a restart
+        stored = await self._run(self._read_link, key)
+        if stored is not None:
+            link = stored
+            self._links.put(key, link)
+            if link.get("unrelayable"):
+                return None
+            if link["digest"] is not None and await self._run(
+                self._touch, self._object_path(link["digest"])
+            ):
+                return link["digest"]
+        elif link is not None:
+            # written before downloading, so whoever serves the file can find
+            # out where it's from
+            await self._run(self._write_link, key, link)
+
+        if link is None:
+            return None
+
+        tmp_path = os.path.join(self.path, "tmp", uuid.uuid4().hex)
+        try:
+            async with self._slots:
+                digest = await self._download(link["url"], tmp_path)
+
+            if digest is None:
+                return None
+
+            await self._run(self._store, tmp_path, digest)
+        except Unrelayable as error:
+            # remembered, so it isn't downloaded over and over
+            log.info("not relaying %s: %s", link["url"], error)
+            link = {**link, "unrelayable": True}
+            self._links.put(key, link)
+            await self._run(self._write_link, key, link)
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            log.warning("failed to download %s: %r", link["url"], error)
+            return None
+        finally:
+            await self._run(self._remove, tmp_path)
+
+        link = {**link, "digest": digest}
+        self._links.put(key, link)
+        await self._run(self._write_link, key, link)
+        return digest
+
+    async def _handle(self, request):
+        key = request.match_info["key"]
+        link = await self._get_link(key)
+        if link is None:
+            MEDIA_REQUESTS.inc(result="missing")
+            raise web.HTTPNotFound()
+
+        unrelayable = link.get("unrelayable", False)
+        digest = None if unrelayable else link["digest"]
+        result = "hit"
+
+        # links are evicted along with files once they go unrequested, so
+        # both are touched
+        stored = await self._run(self._requested, key, digest)
+        if not stored and not unrelayable:
+            # a cancelled request shouldn't cancel the download for everyone
+            digest = await asyncio.shield(self._task_for(key))
+            result = "fetched"
+
+        if digest is None:
+            # it's worth a shot
+            MEDIA_REQUESTS.inc(result="redirect")
+            raise web.HTTPFound(link["url"])
+
+        MEDIA_REQUESTS.inc(result=result)
+        content_type = mimetypes.guess_type(link["name"])[0]
+        return web.FileResponse(
+            self._object_path(digest),
+            headers={
+                "Content-Type": content_type or "application/octet-stream",
+                # the content behind a link never changes
+                "Cache-Control": f"public, max-age={self.max_age}, immutable",
+            },
+        )
+
+    def _evict(self):
+        """Remove expired files and links, then the least recently requested
+        files until the store fits in ``max_size``. Returns the amount of
+        files removed.
+        """
+        expires_before = time.time() - self.max_age
+        removed = 0
+
+        objects = []
+        for directory in os.scandir(os.path.join(self.path, "objects")):
+            for entry in os.scandir(directory.path):
+                stat = entry.stat()
+                if stat.st_mtime < expires_before:
+                    os.remove(entry.path)
+                    removed += 1
+                else:
+                    objects.append((stat.st_mtime, stat.st_size, entry.path))
+
+        stored = sum(size for _, size, _ in objects)
+        for _, size, path in sorted(objects):
+            if stored <= self.max_size:
+                break
+            os.remove(path)
+            stored -= size
+            removed += 1
+
+        # links are kept as long as they're requested, even when their file
+        # was evicted, since it's downloaded again when requested
+        for directory in ("links", "tmp"):
+            for entry in os.scandir(os.path.join(self.path, directory)):
+                if entry.stat().st_mtime < expires_before:
+                    os.remove(entry.path)
+
+        MEDIA_STORED.set(stored)
+        return removed
+
+    async def _evict_periodically(self):
+        interval = self.config.get("evict_interval", 5 * 60)
+        while True:
+            try:
+                removed = await self.loop.run_in_executor(None, self._evict)
+            except Exception:
+                log.exception("failed to evict media")
+            else:
+                if removed:
+                    log.info("evicted %d media files", removed)
+                    MEDIA_EVICTED.inc(removed)
+
+            await asyncio.sleep(interval)
+
+    async def serve(self):
+        """Serve relayed files at ``/media``, and start evicting old ones."""
+        app = web.Application()
+        app.router.add_get("/media/{key:[0-9a-f]{32}}/{name}", self._handle)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+        self._evictor = self.loop.create_task(self._evict_periodically())
+        log.info("serving media on http://%s:%d/media", self.host, self.port)
+
+    async def close(self):
+        """Stop serving and downloading files."""
+        if self._evictor is not None:
+            self._evictor.cancel()
+
+        for task in list(self._inflight.values()):
+            task.cancel()
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+        if self._session is not None:
+            await self._session.close()
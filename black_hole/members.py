@@ -0,0 +1,136 @@
+"""This module keeps track of username collisions in bridged channels.
+
+When bridging a Discord message, the author's discriminator is only shown if
+somebody else in the channel has the same username. Instead of scanning every
+member of the channel for every message, the usernames of each bridged channel
+are counted once and kept up to date from gateway events.
+
+Without the members intent (see ``discord.lazy_members``), only the members
+that happen to be cached are counted up front, and authors are added as their
+messages are bridged.
+"""
+
+__all__ = ["NameIndex"]
+
+import logging
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+
+class ChannelNames:
+    """The usernames of everyone that can see a channel."""
+
+    __slots__ = ("channel", "names", "counts")
+
+    def __init__(self, channel):
+        self.channel = channel
+
+        #: { member_id: username }
+        self.names = {}
+
+        #: { username: amount of members with that username }
+        self.counts = Counter()
+
+        for member in channel.members:
+            self.add(member)
+
+    def add(self, member):
+        self.discard(member.id)
+        self.names[member.id] = member.name
+        self.counts[member.name] += 1
+
+    def discard(self, member_id: int):
+        name = self.names.pop(member_id, None)
+        if name is None:
+            return
+
+        self.counts[name] -= 1
+        if not self.counts[name]:
+            del self.counts[name]
+
+    def update(self, member):
+        """Add, rename or remove a member, depending on whether they can see
+        the channel.
+        """
+        if self.channel.permissions_for(member).read_messages:
+            if self.names.get(member.id) != member.name:
+                self.add(member)
+        else:
+            self.discard(member.id)
+
+
+class NameIndex:
+    """Counts the usernames of the members of bridged channels.
+
+    Channels are indexed the first time a message from them is bridged.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+        #: { channel_id: ChannelNames }
+        self._channels = {}
+
+        client.add_listener(self._on_member_join, "on_member_join")
+        client.add_listener(self._on_member_remove, "on_member_remove")
+        client.add_listener(self._on_member_update, "on_member_update")
+        client.add_listener(self._on_user_update, "on_user_update")
+        client.add_listener(self._on_channel_update, "on_guild_channel_update")
+        client.add_listener(self._on_channel_delete, "on_guild_channel_delete")
+        client.add_listener(self._on_role_update, "on_guild_role_update")
+
+    def is_ambiguous(self, channel, user) -> bool:
+        """Check if somebody else in a channel has the same username as a user."""
+        names = self._channels.get(channel.id)
+        if names is None:
+            names = self._channels[channel.id] = ChannelNames(channel)
+            log.debug("indexed %d members of #%s", len(names.names), channel)
+
+        # authors aren't necessarily cached, so make sure they're counted
+        if names.names.get(user.id) != user.name:
+            names.add(user)
+
+        return names.counts[user.name] > 1
+
+    def _guild_channels(self, guild):
+        for names in self._channels.values():
+            if names.channel.guild == guild:
+                yield names
+
+    async def _on_member_join(self, member):
+        for names in self._guild_channels(member.guild):
+            names.update(member)
+
+    async def _on_member_remove(self, member):
+        for names in self._guild_channels(member.guild):
+            names.discard(member.id)
+
+    async def _on_member_update(self, before, after):
+        # roles may have changed, which changes the channels they can see
+        for names in self._guild_channels(after.guild):
+            names.update(after)
+
+    async def _on_user_update(self, before, after):
+        if before.name == after.name:
+            return
+
+        for names in self._channels.values():
+            member = names.channel.guild.get_member(after.id)
+            if member is not None:
+                names.update(member)
+
+    async def _on_channel_update(self, before, after):
+        if after.id in self._channels:
+            # permission overwrites may have changed, start over
+            self._channels[after.id] = ChannelNames(after)
+
+    async def _on_channel_delete(self, channel):
+        self._channels.pop(channel.id, None)
+
+    async def _on_role_update(self, before, after):
+        if before.permissions == after.permissions:
+            return
+
+        for names in list(self._guild_channels(after.guild)):
+            self._channels[names.channel.id] = ChannelNames(names.channel)
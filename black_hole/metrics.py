@@ -0,0 +1,349 @@
+"""This module collects metrics about the bridge, and serves them over HTTP in
+the Prometheus text format.
+
+Metrics are defined at the module level, and updated from wherever the
+measured thing happens. Metrics that mirror state kept elsewhere (like queue
+depths) are collected through functions when scraped instead.
+"""
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "render",
+    "serve",
+    "MESSAGES",
+    "LATENCY",
+    "QUEUE_DEPTH",
+    "QUEUE_DROPPED",
+    "WEBHOOK_RESPONSES",
+    "RATELIMIT_WAIT",
+    "WEBHOOK_SKIPPED",
+    "AVATAR_CACHE_HITS",
+    "AVATAR_CACHE_MISSES",
+    "MESSAGE_STORE_HITS",
+    "MESSAGE_STORE_MISSES",
+    "XMPP_SEND_ERRORS",
+    "INBOX_DEPTH",
+    "INBOX_DROPPED",
+    "HANDLER_LATENCY",
+    "STAGE_LATENCY",
+    "JOIN_LATENCY",
+    "ROOMS_READY",
+    "FIRST_MESSAGE",
+    "DISCORD_READY",
+    "MAX_RSS",
+    "CAUGHT_UP",
+    "STREAM_RESUMED",
+    "MEDIA_REQUESTS",
+    "MEDIA_FETCHED",
+    "MEDIA_STORED",
+    "MEDIA_EVICTED",
+    "observe_first_message",
+]
+
+import bisect
+import logging
+import resource
+import time
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+#: Every metric that has been defined.
+REGISTRY = []
+
+#: When the bridge started, roughly.
+STARTED_AT = time.monotonic()
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    type_ = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        #: { tuple: value }
+        self._values = {}
+        self._functions = []
+
+        REGISTRY.append(self)
+
+    def _key(self, labels) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def add_function(self, function):
+        """Also collect values of this metric from a function when scraped.
+        The function returns ``{labels: value}``, where ``labels`` is a tuple
+        of label values.
+        """
+        self._functions.append(function)
+
+    def samples(self):
+        values = dict(self._values)
+        for function in self._functions:
+            values.update(function())
+
+        for key, value in values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_ = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type_ = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [bucket counts..., sum, count]
+            state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(names, key + (bound,))
+                yield f"{self.name}_bucket", labels, cumulative
+
+            labels = _format_labels(names, key + ("+Inf",))
+            yield f"{self.name}_bucket", labels, state[-1]
+
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, state[-2]
+            yield f"{self.name}_count", labels, state[-1]
+
+
+def render() -> str:
+    """Render every metric in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+MESSAGES = Counter(
+    "black_hole_messages_total",
+    "Messages bridged, by room and direction.",
+    ("room", "direction"),
+)
+
+LATENCY = Histogram(
+    "black_hole_latency_seconds",
+    "Time from receiving a message to delivering it to the other side.",
+    ("direction",),
+)
+
+QUEUE_DEPTH = Gauge(
+    "black_hole_queue_depth",
+    "Messages waiting to be sent, by room and direction.",
+    ("room", "direction"),
+)
+
+QUEUE_DROPPED = Counter(
+    "black_hole_queue_dropped_total",
+    "Messages dropped because a queue was full, by room and direction.",
+    ("room", "direction"),
+)
+
+WEBHOOK_RESPONSES = Counter(
+    "black_hole_webhook_responses_total",
+    "Responses to webhook requests, by status code.",
+    ("status",),
+)
+
+WEBHOOK_SKIPPED = Counter(
+    "black_hole_webhook_skipped_total",
+    "Webhook jobs dropped because their webhook was deleted.",
+)
+
+RATELIMIT_WAIT = Counter(
+    "black_hole_ratelimit_wait_seconds_total",
+    "Time spent waiting for Discord rate limits to reset.",
+)
+
+AVATAR_CACHE_HITS = Counter(
+    "black_hole_avatar_cache_hits_total", "Avatar lookups served from the cache."
+)
+
+AVATAR_CACHE_MISSES = Counter(
+    "black_hole_avatar_cache_misses_total", "Avatar lookups that had to fetch."
+)
+
+MESSAGE_STORE_HITS = Counter(
+    "black_hole_message_store_hits_total",
+    "Corrections that found the Discord message they correct.",
+)
+
+MESSAGE_STORE_MISSES = Counter(
+    "black_hole_message_store_misses_total",
+    "Corrections that didn't find the Discord message they correct.",
+)
+
+XMPP_SEND_ERRORS = Counter(
+    "black_hole_xmpp_send_errors_total", "Stanzas that failed to be sent to XMPP."
+)
+
+INBOX_DEPTH = Gauge(
+    "black_hole_inbox_depth", "MUC messages waiting to be handled, by room.", ("room",)
+)
+
+INBOX_DROPPED = Counter(
+    "black_hole_inbox_dropped_total",
+    "MUC messages dropped because a room's inbox was full, by room.",
+    ("room",),
+)
+
+HANDLER_LATENCY = Histogram(
+    "black_hole_handler_latency_seconds",
+    "Time spent handling a single message from a MUC.",
+)
+
+STAGE_LATENCY = Histogram(
+    "black_hole_stage_latency_seconds",
+    "Time spent in each stage of sampled messages, by direction and stage.",
+    ("direction", "stage"),
+)
+
+JOIN_LATENCY = Histogram(
+    "black_hole_join_latency_seconds", "Time it took to join a MUC."
+)
+
+ROOMS_READY = Gauge("black_hole_rooms_ready", "MUCs that are currently joined.")
+
+FIRST_MESSAGE = Gauge(
+    "black_hole_first_message_seconds",
+    "Time from startup to the first bridged message, by direction.",
+    ("direction",),
+)
+
+DISCORD_READY = Gauge(
+    "black_hole_discord_ready_seconds",
+    "Time from startup to the Discord client being ready.",
+)
+
+MAX_RSS = Gauge("black_hole_max_rss_bytes", "Peak resident memory of the process.")
+MAX_RSS.add_function(
+    lambda: {(): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+)
+
+CAUGHT_UP = Counter(
+    "black_hole_caught_up_total",
+    "Messages fetched from a MUC's archive after rejoining it, by room.",
+    ("room",),
+)
+
+STREAM_RESUMED = Counter(
+    "black_hole_stream_resumed_total",
+    "XMPP streams that were resumed instead of reconnected from scratch.",
+)
+
+MEDIA_REQUESTS = Counter(
+    "black_hole_media_requests_total",
+    "Requests for relayed media, by whether the file was stored already, had "
+    "to be fetched, was redirected to its origin or is unknown.",
+    ("result",),
+)
+
+MEDIA_FETCHED = Counter(
+    "black_hole_media_fetched_bytes_total", "Bytes of media downloaded to be relayed."
+)
+
+MEDIA_STORED = Gauge(
+    "black_hole_media_stored_bytes", "Bytes of media stored, as of the last eviction."
+)
+
+MEDIA_EVICTED = Counter(
+    "black_hole_media_evicted_total", "Relayed media files that were evicted."
+)
+
+
+def observe_first_message(direction: str):
+    """Record the time to the first bridged message in a direction, if it's
+    the first one.
+    """
+    if (direction,) in FIRST_MESSAGE._values:
+        return
+
+    elapsed = time.monotonic() - STARTED_AT
+    FIRST_MESSAGE.set(elapsed, direction=direction)
+    log.info("first message bridged %s %.2fs after startup", direction, elapsed)
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    """Serve the metrics at ``/metrics``."""
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    log.info("serving metrics on http://%s:%d/metrics", host, port)
+    return runner
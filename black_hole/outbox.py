@@ -0,0 +1,179 @@
+__all__ = ["Outbox"]
+
+import asyncio
+import collections
+import logging
+import time
+
+from .metrics import LATENCY, MESSAGES, XMPP_SEND_ERRORS, observe_first_message
+
+log = logging.getLogger(__name__)
+
+
+class Outbox:
+    """An ordered queue of stanzas to send to a single MUC.
+
+    Stanzas are sent one after another, in the order they were pushed, and
+    paced to a configurable rate so bursts in a Discord channel don't trip the
+    MUC service's rate limits. While the stream is down, or we aren't in the
+    MUC, stanzas are held until we are.
+
+    An outbox holds a bounded amount of stanzas. Once it's full, the oldest
+    stanza is dropped to make room for new ones.
+    """
+
+    def __init__(self, xmpp, jid, *, config):
+        self.xmpp = xmpp
+        self.jid = jid
+
+        self.reconfigure(config)
+
+        #: The amount of stanzas dropped because the outbox was full.
+        self.dropped = 0
+
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+
+        self._overloaded = False
+        self._queue = collections.deque()
+        self._incoming = asyncio.Event()
+        self._task = asyncio.get_event_loop().create_task(self._sender())
+
+    def reconfigure(self, config):
+        """Apply the outbox options of the configuration."""
+        self.size = config.get("size", 1000)
+
+        #: The amount of stanzas that can be sent per second, or 0 to send them
+        #: as fast as possible.
+        self.rate = config.get("rate", 0)
+
+        #: The amount of stanzas that can be sent at once before pacing kicks
+        #: in.
+        self.burst = max(config.get("burst", 5), 1)
+
+    def __len__(self):
+        return self.depth
+
+    @property
+    def depth(self) -> int:
+        """The amount of stanzas waiting to be sent."""
+        return len(self._queue)
+
+    def push(self, stanza, *, received_at=None, trace=None):
+        """Add a stanza to the end of the outbox."""
+        if len(self._queue) >= self.size:
+            if not self._overloaded:
+                log.warning(
+                    "[%s] outbox is full (%d stanzas), dropping the oldest ones",
+                    self.jid,
+                    self.size,
+                )
+                self._overloaded = True
+
+            self._queue.popleft()
+            self.dropped += 1
+        else:
+            self._overloaded = False
+
+        self._queue.append((stanza, received_at, trace))
+        self._incoming.set()
+
+    async def _pace(self):
+        """Wait until another stanza may be sent."""
+        if not self.rate:
+            return
+
+        now = time.monotonic()
+        self._tokens = min(
+            self._tokens + (now - self._refilled_at) * self.rate, self.burst
+        )
+        self._refilled_at = now
+
+        if self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._tokens = 1.0
+            self._refilled_at = time.monotonic()
+
+        self._tokens -= 1
+
+    async def _wait_until_ready(self):
+        established = self.xmpp.client.established_event
+
+        while True:
+            if not established.is_set():
+                log.debug("[%s] waiting for the stream...", self.jid)
+                await established.wait()
+                continue
+
+            room = self.xmpp.rooms.get(self.jid)
+            if room is None:
+                if self.xmpp.router.by_jid(self.jid) is None:
+                    # removed from the configuration, there's nothing to wait for
+                    return
+
+                # the stream is established before the rooms are created
+                log.debug("[%s] waiting for the room...", self.jid)
+                await self.xmpp.wait_for_room(self.jid)
+                continue
+
+            if room.ready.is_set():
+                return
+
+            log.debug("[%s] waiting to join...", self.jid)
+            await room.ready.wait()
+
+    async def _send(self, stanza):
+        """Send a stanza, waiting until we're in the MUC if needed.
+
+        Returns whether the stanza was sent.
+        """
+        while True:
+            await self._wait_until_ready()
+
+            try:
+                await self.xmpp.client.send(stanza)
+                return True
+            except (ConnectionError, OSError):
+                # the stream went down while sending, try again once it's back
+                log.warning("[%s] stream failed while sending, retrying", self.jid)
+                XMPP_SEND_ERRORS.inc()
+                await asyncio.sleep(1)
+            except Exception:
+                log.exception("[%s] failed to send stanza, dropping it", self.jid)
+                XMPP_SEND_ERRORS.inc()
+                return False
+
+    async def _send_all(self):
+        """Send all pending stanzas in this outbox."""
+        log.debug("[%s] working on %d stanzas...", self.jid, self.depth)
+        while self._queue:
+            await self._pace()
+
+            stanza, received_at, trace = self._queue.popleft()
+            if trace is not None:
+                trace.mark("dequeued")
+
+            sent = await self._send(stanza)
+            if trace is not None:
+                trace.mark("sent")
+                self.xmpp.tracer.finish(trace)
+
+            if not sent:
+                continue
+
+            MESSAGES.inc(room=self.jid, direction="to_xmpp")
+            observe_first_message("to_xmpp")
+            if received_at is not None:
+                LATENCY.observe(time.time() - received_at, direction="to_xmpp")
+
+        self._incoming.clear()
+
+    async def drain(self):
+        """Wait until every stanza in the outbox has been sent."""
+        while self._queue or self._incoming.is_set():
+            await asyncio.sleep(0.05)
+
+    async def _sender(self):
+        while True:
+            await self._incoming.wait()
+            await self._send_all()
@@ -0,0 +1,154 @@
+"""This module tracks Discord's rate limits for webhooks.
+
+Discord reports the state of a rate limit bucket in the headers of every
+response. Instead of sleeping a fixed amount after every request, we keep track
+of those headers and only wait when a bucket has actually run dry.
+"""
+
+__all__ = ["Bucket", "RateLimiter"]
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from .metrics import RATELIMIT_WAIT
+
+log = logging.getLogger(__name__)
+
+
+def _header(headers, name: str, type_=float):
+    value = headers.get(name)
+    if value is None:
+        return None
+
+    try:
+        return type_(value)
+    except ValueError:
+        return None
+
+
+class Bucket:
+    """The rate limit state of a single webhook route."""
+
+    __slots__ = ("key", "remaining", "reset_at")
+
+    def __init__(self, key):
+        self.key = key
+
+        #: The number of requests we can make before ``reset_at``. ``None``
+        #: when we don't know (before the first response, or after a reset).
+        self.remaining: Optional[int] = None
+
+        #: The :func:`time.monotonic` timestamp at which the bucket refills.
+        self.reset_at = 0.0
+
+    def delay(self) -> float:
+        """How long we have to wait before making a request in this bucket."""
+        if self.remaining is None or self.remaining > 0:
+            return 0.0
+        return max(self.reset_at - time.monotonic(), 0.0)
+
+    async def acquire(self):
+        """Wait until a request may be made in this bucket, and take a token."""
+        delay = self.delay()
+        if delay > 0:
+            log.debug("bucket %r is empty, waiting %.3fs", self.key, delay)
+            RATELIMIT_WAIT.inc(delay)
+            await asyncio.sleep(delay)
+
+        if time.monotonic() >= self.reset_at:
+            # the bucket has refilled since we last heard from discord, we
+            # don't know how many requests are left until the next response.
+            self.remaining = None
+        elif self.remaining is not None:
+            self.remaining -= 1
+
+    def block(self, seconds: float):
+        """Mark this bucket as exhausted for the given amount of seconds."""
+        self.remaining = 0
+        self.reset_at = max(self.reset_at, time.monotonic() + seconds)
+
+    def update(self, headers):
+        """Update this bucket from the headers of a response."""
+        remaining = _header(headers, "X-RateLimit-Remaining", int)
+        reset_after = _header(headers, "X-RateLimit-Reset-After")
+
+        if remaining is None or reset_after is None:
+            return
+
+        self.remaining = remaining
+        self.reset_at = time.monotonic() + reset_after
+
+
+class RateLimiter:
+    """Keeps track of every rate limit bucket we know of, including the global
+    rate limit.
+    """
+
+    def __init__(self):
+        #: { (method, webhook_url): Bucket }
+        self._routes = {}
+        #: { (X-RateLimit-Bucket, webhook_url): Bucket }
+        self._shared = {}
+        self._global = Bucket("global")
+
+    def bucket(self, method: str, webhook_url: str) -> Bucket:
+        """Get the bucket of a webhook route, creating it if needed.
+
+        Routes are keyed by webhook rather than by URL, so that edits (which
+        each go to their own ``/messages/{id}`` URL) share one bucket.
+        """
+        route = (method, webhook_url)
+        bucket = self._routes.get(route)
+        if bucket is None:
+            bucket = self._routes[route] = Bucket(route)
+        return bucket
+
+    def _share(self, bucket: Bucket, name: str) -> Bucket:
+        """Merge a bucket into the one Discord calls ``name`` for the same
+        webhook, so routes in the same bucket wait on each other.
+        """
+        key = (name, bucket.key[1])
+        shared = self._shared.setdefault(key, bucket)
+        if shared is not bucket:
+            for route, other in self._routes.items():
+                if other is bucket:
+                    self._routes[route] = shared
+        return shared
+
+    async def acquire(self, bucket: Bucket):
+        """Wait until a request may be made in a bucket."""
+        delay = self._global.delay()
+        if delay > 0:
+            log.debug("globally rate limited, waiting %.3fs", delay)
+            RATELIMIT_WAIT.inc(delay)
+            await asyncio.sleep(delay)
+
+        await bucket.acquire()
+
+    def update(self, bucket: Bucket, resp) -> Optional[float]:
+        """Update a bucket from a response.
+
+        When the response is a 429, the amount of seconds to wait before
+        retrying is returned.
+        """
+        name = resp.headers.get("X-RateLimit-Bucket")
+        if name is not None and bucket is not self._global:
+            bucket = self._share(bucket, name)
+
+        bucket.update(resp.headers)
+
+        if resp.status != 429:
+            return None
+
+        retry_after = _header(resp.headers, "Retry-After")
+        if retry_after is None:
+            retry_after = bucket.delay() or 1.0
+
+        if resp.headers.get("X-RateLimit-Global", "").lower() == "true":
+            self._global.block(retry_after)
+        else:
+            bucket.block(retry_after)
+
+        return retry_after
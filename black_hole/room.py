@@ -1,48 +1,284 @@
 __all__ = ["Room"]
 
 import asyncio
+import collections
 import logging
+import time
+from typing import Optional
 
 import aioxmpp
+import aioxmpp.im.dispatcher
+
+from .archive import ArchivedOccupant
+from .metrics import CAUGHT_UP, HANDLER_LATENCY, JOIN_LATENCY
+from .routing import RoomConfig
+from .store import LRU
 
 log = logging.getLogger(__name__)
 
 
 class Room:
-    """An abstraction over :class:`aioxmpp.muc.Room`."""
+    """An abstraction over :class:`aioxmpp.muc.Room`.
+
+    Messages from the MUC are put in a bounded inbox, and handed to the
+    handlers one after another by a worker, in the order they arrived. Once
+    the inbox is full, the oldest messages are dropped.
+
+    :attr:`ready` is set while we're in the MUC, and messages are only sent to
+    it then.
 
-    def __init__(self, xmpp, *, config):
+    When we're rejoined after losing the stream, messages sent in the meantime
+    are fetched from the MUC's archive (if it has one) and handled before any
+    new ones. Messages are deduplicated by the stanza ID the MUC assigned them.
+    """
+
+    def __init__(self, xmpp, *, jid):
         self.loop = asyncio.get_event_loop()
         self.xmpp = xmpp
-        self.config = config
+        self.jid = jid
         self.room = None
 
+        #: Set while we're in the MUC.
+        self.ready = asyncio.Event()
+
+        #: How long it took to join the MUC, in seconds.
+        self.join_latency = None
+
+        self.inbox_size = xmpp.config["xmpp"].get("inbox_size", 1000)
+
+        #: The amount of messages dropped because the inbox was full.
+        self.dropped = 0
+
+        #: The ID the MUC assigned to the last message we got from it, which
+        #: we catch up from after being rejoined.
+        self.last_stanza_id = None
+
+        # stanza ids of recently handled messages, so messages we get both
+        # live and from the archive (or history) are only handled once
+        self._seen = LRU(max_entries=self.inbox_size, max_age=24 * 60 * 60)
+
+        # set when the stream was lost, and we'll be rejoined once it's back
+        self._rejoining = False
+
+        # live messages held while catching up, or None
+        self._held = None
+        self._catch_up_task = None
+
+        self._overloaded = False
+        self._inbox = collections.deque()
+        self._incoming = asyncio.Event()
+        self._task = self.loop.create_task(self._worker())
+
+    @property
+    def config(self) -> Optional[RoomConfig]:
+        """The current configuration of this room, or ``None`` if it has been
+        removed from the configuration.
+        """
+        return self.xmpp.router.by_jid(self.jid)
+
     def _on_topic_changed(self, member, topic, *, nick=None, **kwargs):
         pass
 
+    def _stanza_id(self, msg) -> Optional[str]:
+        for stanza_id in msg.xep0359_stanza_ids:
+            if stanza_id.by is not None and stanza_id.by.bare() == msg.from_.bare():
+                return stanza_id.id_
+        return None
+
     def _on_message(self, msg, member, source, **kwargs):
+        stanza_id = self._stanza_id(msg)
+
         if member == self.room.me:
+            if stanza_id is not None:
+                self.last_stanza_id = stanza_id
+            self.xmpp.on_reflection(msg)
+            return
+
+        if not self.xmpp.receiving:
             return
 
-        content = msg.body.any()
+        message = (msg, member, source, time.time(), stanza_id)
+        if self._held is not None:
+            self._held.append(message)
+            return
+
+        self._enqueue(*message)
+
+    def _enqueue(self, msg, member, source, received_at, stanza_id=None):
+        if stanza_id is not None:
+            if self._seen.get(stanza_id) is not None:
+                return
+            self._seen.put(stanza_id, True)
+            self.last_stanza_id = stanza_id
+
+        config = self.config
+        if config is not None and config.log:
+            content = msg.body.any()
+            log.info("[%s] <%s> %s", self.jid, member.direct_jid, content)
+
+        if len(self._inbox) >= self.inbox_size:
+            if not self._overloaded:
+                log.warning(
+                    "[%s] inbox is full (%d messages), dropping the oldest ones",
+                    self.jid,
+                    self.inbox_size,
+                )
+                self._overloaded = True
 
-        if self.config.get("log", False):
-            log.info("[%s] <%s> %s", self.config["jid"], member.direct_jid, content)
+            self._inbox.popleft()
+            self.dropped += 1
+        else:
+            self._overloaded = False
 
-        # Sent the message over to our parent XMPP class.
-        self.loop.create_task(self.xmpp._handle_message(self, msg, member, source))
+        trace = self.xmpp.tracer.start("to_discord", self.jid)
+        self._inbox.append((msg, member, source, received_at, trace))
+        self._incoming.set()
 
-    def join(self, muc):
-        """Joins this room from a :class:`aioxmpp.MUCClient` using the configuration."""
+    async def _dispatch(self, msg, member, source, received_at, trace):
+        # handlers of every room share a limited amount of slots
+        async with self.xmpp.handler_slots:
+            if trace is not None:
+                trace.mark("dispatched")
 
-        room, _future = muc.join(
-            mucjid=aioxmpp.JID.fromstr(self.config["jid"]),
-            nick=self.config.get("nick", "black-hole"),
-            password=self.config.get("password"),
+            started_at = time.monotonic()
+            try:
+                # Send the message over to our parent XMPP class.
+                await self.xmpp._handle_message(
+                    self, msg, member, source, received_at=received_at, trace=trace
+                )
+            except Exception:
+                log.exception("[%s] failed to handle a message", self.jid)
+
+            HANDLER_LATENCY.observe(time.monotonic() - started_at)
+
+    async def drain(self):
+        """Wait until every message in the inbox has been handled."""
+        while self._inbox or self._incoming.is_set() or self._held is not None:
+            await asyncio.sleep(0.05)
+
+    async def _worker(self):
+        while True:
+            await self._incoming.wait()
+
+            while self._inbox:
+                await self._dispatch(*self._inbox.popleft())
+
+            self._incoming.clear()
+
+    async def _fetch_missed(self, after):
+        archive = self.xmpp.archive
+        if not await archive.supported(self.room.jid):
+            # aioxmpp asks for the history since we left when rejoining, which
+            # is the best we can do
+            log.info("[%s] no archive to catch up from", self.jid)
+            return []
+
+        return await archive.fetch(self.room.jid, after)
+
+    async def _catch_up(self, after):
+        try:
+            missed = await self._fetch_missed(after)
+        except Exception:
+            log.exception("[%s] failed to catch up", self.jid)
+            missed = []
+
+        caught_up = 0
+        for stanza_id, msg in missed:
+            if not msg.body or msg.from_.resource in (None, self.room.me.nick):
+                continue
+
+            self._enqueue(
+                msg,
+                ArchivedOccupant.from_message(msg),
+                aioxmpp.im.dispatcher.MessageSource.STREAM,
+                time.time(),
+                stanza_id,
+            )
+            caught_up += 1
+
+        log.info("[%s] caught up on %d messages", self.jid, caught_up)
+        CAUGHT_UP.inc(caught_up, room=self.jid)
+
+        held, self._held = self._held, None
+        for message in held:
+            self._enqueue(*message)
+
+    def _on_enter(self, *args, **kwargs):
+        self.ready.set()
+
+        rejoining, self._rejoining = self._rejoining, False
+        if (
+            rejoining
+            and self.last_stanza_id is not None
+            and self.xmpp.archive is not None
+            and self._held is None
+        ):
+            # hold new messages until the ones we missed are in the inbox
+            self._held = []
+            self._catch_up_task = self.loop.create_task(
+                self._catch_up(self.last_stanza_id)
+            )
+
+    def _on_muc_suspend(self, *args, **kwargs):
+        # we'll be rejoined automatically once the stream is back
+        self._rejoining = True
+        self.ready.clear()
+
+    def _on_exit(self, *args, **kwargs):
+        self.ready.clear()
+
+    def _join(self, muc):
+        config = self.config
+        room, future = muc.join(
+            mucjid=aioxmpp.JID.fromstr(self.jid),
+            nick=config.nick,
+            password=config.password,
             history=aioxmpp.muc.xso.History(maxstanzas=0),
         )
 
-        room.on_message.connect(self._on_message)
-        room.on_topic_changed.connect(self._on_topic_changed)
+        if room is not self.room:
+            room.on_message.connect(self._on_message)
+            room.on_topic_changed.connect(self._on_topic_changed)
+            room.on_enter.connect(self._on_enter)
+            room.on_muc_suspend.connect(self._on_muc_suspend)
+            room.on_exit.connect(self._on_exit)
+            self.room = room
+
+        return future
+
+    async def join(self, muc, *, timeout: float = 30, retries: int = 3) -> bool:
+        """Joins this room from a :class:`aioxmpp.MUCClient` using the configuration.
+
+        Returns whether the room was joined.
+        """
+        for attempt in range(retries + 1):
+            started_at = time.monotonic()
+            try:
+                # a join that times out is cancelled, which makes aioxmpp
+                # abandon it so we can start over
+                await asyncio.wait_for(self._join(muc), timeout)
+            except asyncio.TimeoutError:
+                log.warning("[%s] timed out joining after %.1fs", self.jid, timeout)
+            except Exception as error:
+                log.warning("[%s] failed to join: %r", self.jid, error)
+            else:
+                self.join_latency = time.monotonic() - started_at
+                JOIN_LATENCY.observe(self.join_latency)
+                self.ready.set()
+                return True
+
+            if attempt < retries:
+                await asyncio.sleep(min(2**attempt, 30))
+
+        log.error("[%s] giving up on joining after %d attempts", self.jid, retries + 1)
+        return False
+
+    async def leave(self):
+        """Leaves this room."""
+        self._task.cancel()
+        if self._catch_up_task is not None:
+            self._catch_up_task.cancel()
+        self.ready.clear()
 
-        self.room = room
+        if self.room is not None:
+            await self.room.leave()
@@ -0,0 +1,102 @@
+"""This module compiles the room configuration into lookup tables.
+
+Looking up rooms happens for every bridged message in both directions, so
+instead of scanning ``config["rooms"]`` each time, the rooms are indexed by
+channel ID and JID once, and re-indexed whenever the configuration changes.
+"""
+
+__all__ = ["RoomConfig", "RoutingTable", "Router"]
+
+import logging
+from collections import namedtuple
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+
+class RoomConfig(
+    namedtuple(
+        "RoomConfig",
+        (
+            "jid",
+            "channel_id",
+            "webhook",
+            "webhooks",
+            "nick",
+            "password",
+            "log",
+            "discord_log",
+            "disabled",
+            "raw",
+        ),
+    )
+):
+    """An immutable snapshot of a room's configuration.
+
+    ``raw`` is the room's dictionary in the configuration, which is what gets
+    modified (and saved) by management commands.
+
+    ``webhook`` may be a single URL or a list of them in the configuration.
+    ``webhooks`` is always a tuple of every URL, and ``webhook`` the first one.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, raw) -> "RoomConfig":
+        webhooks = raw["webhook"]
+        if isinstance(webhooks, str):
+            webhooks = (webhooks,)
+        elif not webhooks:
+            raise ValueError(f"room {raw['jid']} has no webhooks")
+
+        return cls(
+            jid=raw["jid"],
+            channel_id=int(raw["channel_id"]),
+            webhook=webhooks[0],
+            webhooks=tuple(webhooks),
+            nick=raw.get("nick", "black-hole"),
+            password=raw.get("password"),
+            log=raw.get("log", False),
+            discord_log=raw.get("discord_log", False),
+            disabled=raw.get("disabled", False),
+            raw=raw,
+        )
+
+
+class RoutingTable:
+    """Rooms indexed by their Discord channel ID and MUC JID."""
+
+    __slots__ = ("rooms", "by_channel", "by_jid")
+
+    def __init__(self, rooms):
+        self.rooms = tuple(RoomConfig.from_dict(raw) for raw in rooms)
+        self.by_channel = {room.channel_id: room for room in self.rooms}
+        self.by_jid = {room.jid: room for room in self.rooms}
+
+
+class Router:
+    """Holds the current :class:`RoutingTable`, built from the configuration."""
+
+    def __init__(self, config):
+        self.config = config
+        self.table = RoutingTable(config["rooms"])
+
+    @property
+    def rooms(self):
+        return self.table.rooms
+
+    def rebuild(self):
+        """Rebuild the routing table after the configuration has changed.
+
+        The new table replaces the old one in a single step, so lookups never
+        see a half-built table.
+        """
+        self.table = RoutingTable(self.config["rooms"])
+        log.debug("rebuilt routing table with %d rooms", len(self.table.rooms))
+
+    def by_channel(self, channel_id: int) -> Optional[RoomConfig]:
+        return self.table.by_channel.get(channel_id)
+
+    def by_jid(self, jid: str) -> Optional[RoomConfig]:
+        return self.table.by_jid.get(jid)
@@ -0,0 +1,142 @@
+"""This module strips mentions from messages crossing the bridge.
+
+Both directions are handled with a single precompiled regular expression pass:
+
+- :func:`clean_content` prevents messages from XMPP mentioning anyone when
+  posted to Discord.
+- :class:`Sanitizer` replaces mentions in Discord messages with readable names
+  before they are sent to XMPP. Its output is identical to discord.py's
+  ``commands.clean_content(use_nicknames=False)`` converter.
+"""
+
+__all__ = ["clean_content", "Sanitizer"]
+
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+#: Matches everything that needs escaping in a message going to Discord.
+TO_DISCORD_RE = re.compile(r"@(everyone|here)|<@([!&]?\d+)>")
+
+#: Matches user and role mentions in a message coming from Discord (first
+#: alternative), as well as anything discord.py's ``escape_mentions`` would
+#: escape (second alternative).
+FROM_DISCORD_RE = re.compile(r"<@([!&]?)([0-9]+)>|@(everyone|here|[!&]?[0-9]{17,21})")
+
+ESCAPE_RE = re.compile(r"@(everyone|here|[!&]?[0-9]{17,21})")
+
+
+def _to_discord_replacer(match):
+    mass_mention = match.group(1)
+    if mass_mention:
+        return "@\u200b" + mass_mention
+    # "<@!123>" becomes "@!123"
+    return "@" + match.group(2)
+
+
+def clean_content(content: str) -> str:
+    """Prevent mentions in strings being sent as messages to Discord."""
+    # most messages don't mention anything, and checking for that is a lot
+    # cheaper than running the regex
+    if "@" not in content:
+        return content
+    return TO_DISCORD_RE.sub(_to_discord_replacer, content)
+
+
+def escape_mentions(text: str) -> str:
+    return ESCAPE_RE.sub("@\u200b\\1", text)
+
+
+class Sanitizer:
+    """Replaces mentions in Discord messages with the names of whoever (or
+    whatever) they mention.
+
+    Resolved names are cached until the user or role they belong to changes.
+    """
+
+    #: How many resolved names to keep before starting over.
+    MAX_CACHED = 10000
+
+    def __init__(self, client):
+        self.client = client
+
+        #: { (str, int): str }
+        # the key is ("user", id) or ("role", id), and the value is what
+        # the mention is replaced with (already escaped).
+        self._names = {}
+
+        client.add_listener(self._on_user_update, "on_user_update")
+        client.add_listener(self._on_member_join, "on_member_join")
+        client.add_listener(self._on_role_change, "on_guild_role_update")
+        client.add_listener(self._on_role_change, "on_guild_role_delete")
+        client.add_listener(self._on_role_change, "on_guild_role_create")
+
+    def _resolve(self, kind: str, id_: int, message) -> str:
+        key = (kind, id_)
+        name = self._names.get(key)
+        if name is not None:
+            return name
+
+        if kind == "user":
+            user = self.client.get_user(id_)
+            if user is None:
+                # mentioned users come with the message, even if they aren't
+                # cached
+                user = next((u for u in message.mentions if u.id == id_), None)
+            name = "@" + user.name if user else "@deleted-user"
+        else:
+            role = message.guild.get_role(id_)
+            name = "@" + role.name if role else "@deleted-role"
+
+        if len(self._names) >= self.MAX_CACHED:
+            self._names.clear()
+
+        # names are escaped the same way the rest of the message is
+        name = self._names[key] = escape_mentions(name)
+        return name
+
+    def clean(self, message, content: str) -> str:
+        """Clean the mentions out of some content from a Discord message.
+
+        Like discord.py, only mentions that are present in the content of the
+        message itself are resolved.
+        """
+        if "@" not in content:
+            return content
+
+        guild = message.guild
+
+        # ids are compared as strings, exactly as they appear in the message
+        users = {str(id_) for id_ in message.raw_mentions}
+        roles = {str(id_) for id_ in message.raw_role_mentions} if guild else ()
+
+        def replacer(match):
+            escaped = match.group(3)
+            if escaped is not None:
+                return "@\u200b" + escaped
+
+            kind, id_ = match.group(1), match.group(2)
+            if kind == "&":
+                if id_ in roles:
+                    return self._resolve("role", int(id_), message)
+            elif id_ in users:
+                return self._resolve("user", int(id_), message)
+
+            # not an actual mention of the message, leave it as is (but
+            # escaped)
+            return escape_mentions(match.group(0))
+
+        return FROM_DISCORD_RE.sub(replacer, content)
+
+    async def _on_user_update(self, before, after):
+        if before.name != after.name:
+            self._names.pop(("user", after.id), None)
+
+    async def _on_member_join(self, member):
+        # the user may have been cached as a deleted user
+        self._names.pop(("user", member.id), None)
+
+    async def _on_role_change(self, *roles):
+        for role in roles:
+            self._names.pop(("role", role.id), None)
@@ -0,0 +1,567 @@
+"""This module runs the bridge across several processes.
+
+A supervisor process owns the connection to the Discord gateway, and splits the
+rooms across worker processes. Every worker runs its own XMPP client (optionally
+with its own account) and bridges messages from its rooms to Discord on its
+own. Messages from Discord are formatted by the supervisor and relayed to the
+worker that owns the room.
+
+The supervisor talks to its workers over their standard input and output, one
+JSON object per line. It sends them their configuration (and any changes to
+it) and messages from Discord, and they regularly send back a heartbeat.
+Workers that exit or stop sending heartbeats are restarted.
+
+Workers are started with ``python -m black_hole.sharding <index> <heartbeat>
+<loop>``.
+"""
+
+__all__ = ["Supervisor", "shard_of", "worker_config"]
+
+import asyncio
+import collections
+import copy
+import json
+import logging
+import os
+import signal
+import sys
+import time
+import zlib
+
+from .black_hole import BlackHole
+from . import eventloop
+from .config import ConfigFile
+from .discord import make_client
+from .management import Management
+from .media import MediaRelay
+from .members import NameIndex
+from .routing import Router, RoutingTable
+from .sanitize import Sanitizer
+from .tracing import Tracer
+from .xmpp import extract_message_content, format_discord_message
+
+log = logging.getLogger(__name__)
+
+#: The maximum number of messages kept for a worker while it's restarting, or
+#: not keeping up.
+PENDING_SIZE = 1000
+
+#: How many bytes may be waiting to be written to a worker before messages are
+#: held back for it instead.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+#: How long a worker has to run for to be considered healthy, in seconds.
+#: Workers that exit before that are restarted with an increasing delay.
+STABLE_AFTER = 60
+
+
+def shard_of(room, workers: int) -> int:
+    """Get the index of the worker that bridges a room, from the room's
+    dictionary in the configuration.
+    """
+    if "shard" in room:
+        return int(room["shard"]) % workers
+    return zlib.crc32(room["jid"].encode()) % workers
+
+
+def _suffixed(path: str, index: int) -> str:
+    root, extension = os.path.splitext(path)
+    return f"{root}.{index}{extension}"
+
+
+def worker_config(config, index: int, workers: int):
+    """Derive the configuration of a worker from the supervisor's."""
+    config = copy.deepcopy(config)
+    sharding = config.pop("sharding")
+
+    config["rooms"] = [
+        room for room in config["rooms"] if shard_of(room, workers) == index
+    ]
+
+    accounts = sharding.get("accounts", [])
+    if index < len(accounts):
+        config["xmpp"].update(accounts[index])
+
+    # every worker needs a database of its own
+    discord_config = config["discord"]
+    for key, default in (
+        ("journal", "journal.sqlite3"),
+        ("message_store", None),
+    ):
+        section = discord_config.get(key)
+        if section is not None and section.get("path", default) is not None:
+            section["path"] = _suffixed(section.get("path", default), index)
+
+    metrics_config = config.get("metrics")
+    if metrics_config is not None:
+        metrics_config["port"] = metrics_config.get("port", 9100) + index
+
+    # workers share the media directory, which the supervisor serves
+    media_config = config.get("media")
+    if media_config is not None:
+        media_config["serve"] = False
+
+    return config
+
+
+class Shard:
+    """A worker process bridging a part of the rooms."""
+
+    def __init__(self, supervisor, index: int):
+        self.supervisor = supervisor
+        self.index = index
+
+        #: The :class:`asyncio.subprocess.Process` of the worker.
+        self.process = None
+
+        #: The :func:`time.monotonic` timestamp of the last heartbeat.
+        self.last_heartbeat = 0.0
+
+        #: The amount of times the worker was restarted.
+        self.restarts = 0
+
+        self._stopped = False
+
+        # messages that came in while the worker wasn't running, or wasn't
+        # reading them fast enough
+        self._pending = collections.deque(maxlen=PENDING_SIZE)
+        self._flusher = None
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def _congested(self) -> bool:
+        return self.process.stdin.transport.get_write_buffer_size() > WRITE_BUFFER_SIZE
+
+    def send(self, message):
+        """Send a message to the worker."""
+        line = json.dumps(message).encode() + b"\n"
+
+        if self.running and not self._pending and not self._congested():
+            self.process.stdin.write(line)
+            return
+
+        # held back until the worker is running and has caught up, dropping
+        # the oldest messages if there are too many
+        self._pending.append(line)
+        if self.running:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        if self._flusher is None:
+            self._flusher = asyncio.get_event_loop().create_task(self._flush())
+            self._flusher.add_done_callback(self._flushed)
+
+    def _flushed(self, task: asyncio.Task):
+        if self._flusher is task:
+            self._flusher = None
+
+    async def _flush(self):
+        """Write held back messages to the worker as it reads them."""
+        while self._pending and self.running:
+            stdin = self.process.stdin
+            while self._pending and not self._congested():
+                stdin.write(self._pending.popleft())
+
+            try:
+                await stdin.drain()
+            except ConnectionError:
+                # the worker exited, what's left is sent once it's back
+                return
+
+    def send_config(self):
+        """Send the worker its current configuration."""
+        self.send({"type": "config", "config": self.supervisor.worker_config(self)})
+
+    async def _spawn(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "black_hole.sharding",
+            str(self.index),
+            str(self.supervisor.heartbeat),
+            self.supervisor.config.get("loop", "asyncio"),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self.last_heartbeat = time.monotonic()
+        log.info("started worker %d (pid %d)", self.index, self.process.pid)
+
+        # the first line is the configuration to boot with
+        config = self.supervisor.worker_config(self)
+        self.process.stdin.write(json.dumps(config).encode() + b"\n")
+
+        if self._flusher is not None:
+            # still waiting on the previous process
+            self._flusher.cancel()
+            self._flusher = None
+        if self._pending:
+            self._flush_pending()
+
+    async def _read(self):
+        async for line in self.process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+
+            if message.get("type") == "heartbeat":
+                self.last_heartbeat = time.monotonic()
+
+    async def _watch(self):
+        """Wait until the worker exits, killing it if it stops responding."""
+        heartbeat = self.supervisor.heartbeat
+        timeout = self.supervisor.timeout
+
+        reader = asyncio.get_event_loop().create_task(self._read())
+        try:
+            while self.process.returncode is None:
+                try:
+                    await asyncio.wait_for(self.process.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    pass
+
+                silent_for = time.monotonic() - self.last_heartbeat
+                if self.process.returncode is None and silent_for > timeout:
+                    log.warning(
+                        "worker %d hasn't responded in %.0fs, killing it",
+                        self.index,
+                        silent_for,
+                    )
+                    self.process.kill()
+                    await self.process.wait()
+        finally:
+            reader.cancel()
+
+        log.warning("worker %d exited with %d", self.index, self.process.returncode)
+
+    async def run(self):
+        """Run the worker, restarting it whenever it exits."""
+        delay = 1
+        while True:
+            started_at = time.monotonic()
+            await self._spawn()
+            await self._watch()
+
+            if self._stopped:
+                return
+
+            if time.monotonic() - started_at > STABLE_AFTER:
+                delay = 1
+
+            log.info("restarting worker %d in %ds", self.index, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+            self.restarts += 1
+
+    def stop(self):
+        self._stopped = True
+        if self.running:
+            self.process.terminate()
+
+
+class Supervisor:
+    """Owns the Discord gateway, and relays messages to the workers bridging
+    the rooms they belong to.
+    """
+
+    def __init__(self, *, config, config_path=None):
+        self.config = config
+        self.loop = asyncio.get_event_loop()
+
+        sharding = config["sharding"]
+        self.workers = sharding.get("workers") or os.cpu_count() or 1
+        self.heartbeat = sharding.get("heartbeat", 5)
+        self.timeout = sharding.get("timeout", 30)
+
+        #: Set once we're shutting down, after which no new messages from
+        #: Discord are relayed.
+        self.stopping = False
+        self._shutdown_task = None
+
+        self.config_file = None
+        if config_path is not None:
+            self.config_file = ConfigFile(config_path, config, loop=self.loop)
+            self.config_file.on_reload.append(self.on_config_reload)
+            self.config_file.on_save.append(self.push_config)
+
+        self.router = Router(config)
+
+        # traces live in the workers, but the debug command works here too
+        self.tracer = Tracer(config)
+
+        # lanes live in the workers
+        self._lanes = {}
+
+        self.client = make_client(
+            lazy_members=config["discord"].get("lazy_members", False)
+        )
+        self.client.add_cog(
+            Management(
+                self.client, self.config, bridge=self, config_file=self.config_file
+            )
+        )
+        self.names = NameIndex(self.client)
+        self.sanitizer = Sanitizer(self.client)
+
+        self.media = None
+        if config.get("media") is not None:
+            self.media = MediaRelay(config["media"])
+
+        self.shards = [Shard(self, index) for index in range(self.workers)]
+
+        self.client.add_listener(self.on_discord_message, "on_message")
+        self.client.add_listener(self.on_discord_message_edit, "on_message_edit")
+        self.client.add_listener(
+            self.on_discord_message_delete, "on_raw_message_delete"
+        )
+        self.client.add_listener(
+            self.on_discord_bulk_message_delete, "on_raw_bulk_message_delete"
+        )
+
+    def worker_config(self, shard: Shard):
+        return worker_config(self.config, shard.index, self.workers)
+
+    def shard_for(self, room_config) -> Shard:
+        return self.shards[shard_of(room_config.raw, self.workers)]
+
+    def push_config(self):
+        """Send the current configuration to every worker."""
+        for shard in self.shards:
+            shard.send_config()
+
+    def on_config_reload(self, config):
+        """Apply a configuration that was changed on disk."""
+        RoutingTable(config["rooms"])
+
+        if config.get("sharding") != self.config.get("sharding"):
+            log.warning("sharding changed, restart to apply it")
+            config["sharding"] = self.config["sharding"]
+
+        self.config.clear()
+        self.config.update(config)
+
+        self.router.rebuild()
+        self.push_config()
+
+    def relay(self, message, *, edited=False):
+        """Format a Discord message, and relay it to the worker bridging its
+        channel.
+        """
+        room = self.router.by_channel(message.channel.id)
+
+        if room is None or room.disabled:
+            return
+
+        if room.discord_log:
+            content = extract_message_content(message)
+            log.info("[discord] <%s> %s", message.author, content)
+
+        self.shard_for(room).send(
+            {
+                "type": "message",
+                "room": room.jid,
+                "content": format_discord_message(
+                    message,
+                    names=self.names,
+                    sanitizer=self.sanitizer,
+                    media=self.media,
+                ),
+                "message_id": message.id,
+                "edited": edited,
+                "received_at": time.time(),
+            }
+        )
+
+    def retract(self, channel_id, message_ids):
+        """Relay the deletion of Discord messages to the worker bridging their
+        channel.
+        """
+        room = self.router.by_channel(channel_id)
+        if room is None or room.disabled or self.stopping:
+            return
+
+        self.shard_for(room).send(
+            {"type": "retract", "room": room.jid, "message_ids": list(message_ids)}
+        )
+
+    async def on_discord_message(self, message):
+        if message.webhook_id is not None or self.stopping:
+            return
+
+        try:
+            self.relay(message)
+        except Exception:
+            log.exception("failed to relay a message from discord")
+
+    async def on_discord_message_edit(self, before, after):
+        if after.webhook_id is not None or before.content == after.content:
+            return
+
+        if self.stopping:
+            return
+
+        try:
+            self.relay(after, edited=True)
+        except Exception:
+            log.exception("failed to relay an edit from discord")
+
+    async def on_discord_message_delete(self, payload):
+        self.retract(payload.channel_id, [payload.message_id])
+
+    async def on_discord_bulk_message_delete(self, payload):
+        self.retract(payload.channel_id, payload.message_ids)
+
+    async def shutdown(self):
+        """Stop relaying messages, and wait for the workers to drain their
+        queues and exit.
+        """
+        self.stopping = True
+
+        # workers get shutdown_timeout seconds to drain, and a bit more to
+        # disconnect
+        timeout = self.config.get("shutdown_timeout", 10) + 5
+        log.info("stopping %d workers", self.workers)
+
+        running = [shard for shard in self.shards if shard.running]
+        for shard in self.shards:
+            shard.stop()
+
+        if running:
+            await asyncio.wait(
+                [self.loop.create_task(shard.process.wait()) for shard in running],
+                timeout=timeout,
+            )
+
+        for shard in running:
+            if shard.running:
+                log.warning("worker %d didn't exit in time, killing it", shard.index)
+                shard.process.kill()
+
+        if self.media is not None:
+            await self.media.close()
+
+        if self.config_file is not None and self.config_file.pending:
+            await self.config_file.flush()
+
+        await self.client.logout()
+        log.info("stopped")
+
+    def stop(self):
+        """Shut down gracefully, then stop the event loop."""
+        if self._shutdown_task is not None:
+            return
+
+        async def shutdown():
+            try:
+                await self.shutdown()
+            finally:
+                self.loop.stop()
+
+        self._shutdown_task = self.loop.create_task(shutdown())
+
+    def run(self):
+        log.info("booting %d workers", self.workers)
+        for shard in self.shards:
+            self.loop.create_task(shard.run())
+
+        self.loop.create_task(self.client.start(self.config["discord"]["token"]))
+
+        if self.config_file is not None:
+            self.loop.create_task(self.config_file.watch())
+
+        if self.media is not None:
+            self.loop.create_task(self.media.serve())
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.stop)
+            except NotImplementedError:
+                pass
+
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            self.loop.run_until_complete(self.shutdown())
+        finally:
+            self.loop.close()
+
+
+class Worker:
+    """Bridges the rooms of a single shard, as told by the supervisor."""
+
+    def __init__(self, bh: BlackHole, reader, *, heartbeat: float):
+        self.bh = bh
+        self.reader = reader
+        self.heartbeat = heartbeat
+
+    def handle(self, message):
+        type_ = message.get("type")
+
+        if type_ == "message":
+            room = self.bh.router.by_jid(message["room"])
+            if room is None or room.disabled:
+                return
+
+            self.bh.xmpp.relay(
+                room,
+                message["content"],
+                message_id=message["message_id"],
+                edited=message["edited"],
+                received_at=message["received_at"],
+                trace=self.bh.tracer.start("to_xmpp", room.jid),
+            )
+        elif type_ == "retract":
+            room = self.bh.router.by_jid(message["room"])
+            if room is None or room.disabled:
+                return
+
+            for message_id in message["message_ids"]:
+                self.bh.xmpp.retract(room, message_id)
+        elif type_ == "config":
+            self.bh.on_config_reload(message["config"])
+
+    async def _beat(self):
+        while True:
+            sys.stdout.buffer.write(b'{"type": "heartbeat"}\n')
+            sys.stdout.buffer.flush()
+            await asyncio.sleep(self.heartbeat)
+
+    async def run(self):
+        beat = self.bh.loop.create_task(self._beat())
+
+        async for line in self.reader:
+            try:
+                self.handle(json.loads(line))
+            except Exception:
+                log.exception("failed to handle a message from the supervisor")
+
+        # the supervisor is gone, and so should we
+        log.warning("lost the supervisor, stopping")
+        beat.cancel()
+        self.bh.stop()
+
+
+def main():
+    index, heartbeat = int(sys.argv[1]), float(sys.argv[2])
+    logging.basicConfig(
+        level="INFO", format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s"
+    )
+    eventloop.install(sys.argv[3] if len(sys.argv) > 3 else "asyncio")
+
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=2**24)
+    loop.run_until_complete(
+        loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    )
+    config = json.loads(loop.run_until_complete(reader.readline()))
+
+    bh = BlackHole(config=config, gateway=False)
+    worker = Worker(bh, reader, heartbeat=heartbeat)
+    loop.create_task(worker.run())
+    bh.run()
+
+
+if __name__ == "__main__":
+    main()
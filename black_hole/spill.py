@@ -0,0 +1,139 @@
+__all__ = ["SpillFile"]
+
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import quote
+
+log = logging.getLogger(__name__)
+
+
+class SpillFile:
+    """An append-only file of webhook jobs that didn't fit in a lane.
+
+    Jobs are stored one JSON object per line, and read back in the order they
+    were written. Once every job has been read back, the file is truncated.
+
+    Appended jobs are buffered and written in batches from a background
+    thread, and reads happen there as well, so spilling never blocks the event
+    loop.
+    """
+
+    def __init__(self, directory: str, key: str, *, loop):
+        self.path = os.path.join(directory, quote(key, safe="@.") + ".jsonl")
+        self.loop = loop
+        self._directory = directory
+
+        #: The offset in the file up to which jobs have been read back.
+        self._offset = 0
+
+        #: The amount of jobs that haven't been read back yet, including the
+        #: ones that haven't been written yet.
+        self.pending = 0
+
+        #: Lines waiting to be written to the file.
+        self._buffer = []
+        self._flusher = None
+
+        # reads and writes must not overlap, or jobs could be read back before
+        # older ones were written
+        self._lock = asyncio.Lock()
+
+        # pick up jobs spilled before a restart
+        if os.path.exists(self.path):
+            with open(self.path, "r") as fp:
+                self.pending = sum(1 for _ in fp)
+
+    def __len__(self):
+        return self.pending
+
+    def clear(self):
+        """Throw away every job in the file.
+
+        This blocks, so it should only be called on startup.
+        """
+        if os.path.exists(self.path):
+            os.truncate(self.path, 0)
+        self._buffer = []
+        self._offset = 0
+        self.pending = 0
+
+    def append(self, job):
+        """Add a job to the end of the file. It's written in the background."""
+        self._buffer.append(json.dumps(job) + "\n")
+        self.pending += 1
+
+        if self._flusher is None:
+            self._flusher = self.loop.create_task(self._flush_in_background())
+
+    async def _flush_in_background(self):
+        try:
+            await self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # the lines stay buffered, and are written before the next read
+            log.exception("failed to write spilled jobs to %s", self.path)
+        finally:
+            self._flusher = None
+
+    async def flush(self):
+        """Write every buffered job to the file."""
+        async with self._lock:
+            await self._write_buffer()
+
+    async def _write_buffer(self):
+        while self._buffer:
+            lines, self._buffer = self._buffer, []
+            try:
+                await self.loop.run_in_executor(None, self._write, lines)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._buffer[:0] = lines
+                raise
+
+    def _write(self, lines):
+        os.makedirs(self._directory, exist_ok=True)
+        with open(self.path, "a") as fp:
+            fp.writelines(lines)
+
+    async def read(self, count: int) -> list:
+        """Read back up to ``count`` jobs, oldest first."""
+        async with self._lock:
+            if not self.pending:
+                return []
+
+            await self._write_buffer()
+            jobs, lines, self._offset = await self.loop.run_in_executor(
+                None, self._read, count, self._offset
+            )
+
+            self.pending = max(self.pending - lines, 0)
+
+            if not lines or not self.pending:
+                # everything was read back, start over with an empty file
+                await self.loop.run_in_executor(None, os.truncate, self.path, 0)
+                self._offset = 0
+                # jobs appended in the meantime are still buffered
+                self.pending = len(self._buffer)
+
+        return jobs
+
+    def _read(self, count: int, offset: int):
+        jobs = []
+        lines = 0
+        with open(self.path, "r") as fp:
+            fp.seek(offset)
+            while lines < count:
+                line = fp.readline()
+                if not line:
+                    break
+
+                lines += 1
+                try:
+                    jobs.append(json.loads(line))
+                except ValueError:
+                    log.warning("skipping corrupt line in %s", self.path)
+            return jobs, lines, fp.tell()
@@ -0,0 +1,225 @@
+"""This module maps XMPP messages to the Discord messages they were bridged to.
+
+The mapping is what allows XEP-0308 corrections coming from a MUC to be
+reflected on Discord by editing the original message, instead of sending a new
+one. Since a room can post through several webhooks, and a message can only be
+edited through the webhook that posted it, the webhook is kept as well.
+
+Recent mappings are kept in memory, and can optionally be persisted to SQLite so
+they survive restarts and cover more messages than fit in memory.
+"""
+
+__all__ = ["MessageStore"]
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from .database import Database
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    author_jid TEXT NOT NULL,
+    xmpp_message_id TEXT NOT NULL,
+    discord_message_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    webhook_url TEXT,
+    PRIMARY KEY (author_jid, xmpp_message_id)
+);
+CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+
+CREATE TABLE IF NOT EXISTS segments (
+    discord_message_id TEXT PRIMARY KEY,
+    segments TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_created_at ON segments (created_at);
+"""
+
+#: How many writes to make between pruning expired rows from the database.
+PRUNE_EVERY = 1000
+
+
+class LRU:
+    """A bounded mapping that expires entries after a while and evicts the
+    least recently used ones once full.
+    """
+
+    def __init__(self, *, max_entries: int, max_age: float):
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+        #: { key: (created_at, value) }
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        created_at, value = entry
+        if time.time() - created_at > self.max_age:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return None if entry is None else entry[1]
+
+    def put(self, key, value, created_at: Optional[float] = None):
+        self._entries[key] = (created_at or time.time(), value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class MessageStore:
+    """Maps ``(author_jid, xmpp_message_id)`` to Discord message IDs.
+
+    It also keeps the segments of coalesced messages (see
+    :func:`black_hole.lane.merge`), keyed by Discord message ID.
+    """
+
+    def __init__(
+        self,
+        *,
+        loop,
+        max_entries: int = 10000,
+        max_age: float = 24 * 60 * 60,
+        path: Optional[str] = None,
+        commit_interval: float = 0.5,
+    ):
+        self.max_age = max_age
+
+        self._messages = LRU(max_entries=max_entries, max_age=max_age)
+        self._segments = LRU(max_entries=max_entries, max_age=max_age)
+
+        self.db = None
+        if path is not None:
+            self.db = Database(
+                path, loop=loop, schema=SCHEMA, commit_interval=commit_interval
+            )
+            self._migrate()
+
+        self._writes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _migrate(self):
+        columns = {row[1] for row in self.db.query("PRAGMA table_info(messages)")}
+        if "webhook_url" not in columns:
+            # databases from before rooms could have several webhooks
+            self.db.query("ALTER TABLE messages ADD COLUMN webhook_url TEXT")
+
+    async def get(
+        self, author_jid: str, xmpp_message_id: str
+    ) -> Optional[Tuple[str, Optional[str]]]:
+        """Get the Discord message an XMPP message was bridged to, as a
+        ``(discord_message_id, webhook_url)`` tuple.
+
+        The webhook is ``None`` for messages remembered before it was kept.
+        """
+        key = (author_jid, xmpp_message_id)
+        message = self._messages.get(key)
+
+        if message is None and self.db is not None:
+            rows = await self.db.fetch(
+                "SELECT discord_message_id, webhook_url, created_at FROM messages "
+                "WHERE author_jid = ? AND xmpp_message_id = ? AND created_at > ?",
+                (author_jid, xmpp_message_id, time.time() - self.max_age),
+            )
+            if rows:
+                discord_message_id, webhook_url, created_at = rows[0]
+                message = (discord_message_id, webhook_url)
+                self._messages.put(key, message, created_at)
+
+        if message is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return message
+
+    def put(
+        self,
+        author_jid: str,
+        xmpp_message_id: str,
+        discord_message_id: str,
+        webhook_url: Optional[str] = None,
+    ):
+        """Remember the Discord message an XMPP message was bridged to, and the
+        webhook that posted it.
+        """
+        now = time.time()
+        self._messages.put(
+            (author_jid, xmpp_message_id), (discord_message_id, webhook_url), now
+        )
+
+        if self.db is not None:
+            self.db.write(
+                "INSERT OR REPLACE INTO messages "
+                "(author_jid, xmpp_message_id, discord_message_id, created_at, "
+                "webhook_url) VALUES (?, ?, ?, ?, ?)",
+                (author_jid, xmpp_message_id, discord_message_id, now, webhook_url),
+            )
+            self._wrote()
+
+    async def get_segments(self, discord_message_id: str) -> Optional[list]:
+        """Get the segments of a coalesced message."""
+        segments = self._segments.get(discord_message_id)
+
+        if segments is None and self.db is not None:
+            rows = await self.db.fetch(
+                "SELECT segments, created_at FROM segments "
+                "WHERE discord_message_id = ? AND created_at > ?",
+                (discord_message_id, time.time() - self.max_age),
+            )
+            if rows:
+                segments, created_at = json.loads(rows[0][0]), rows[0][1]
+                self._segments.put(discord_message_id, segments, created_at)
+
+        return segments
+
+    def put_segments(self, discord_message_id: str, segments: list):
+        """Remember the segments of a coalesced message."""
+        now = time.time()
+        self._segments.put(discord_message_id, segments, now)
+
+        if self.db is not None:
+            self.db.write(
+                "INSERT OR REPLACE INTO segments VALUES (?, ?, ?)",
+                (discord_message_id, json.dumps(segments), now),
+            )
+            self._wrote()
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes % PRUNE_EVERY:
+            return
+
+        cutoff = time.time() - self.max_age
+        self.db.write("DELETE FROM messages WHERE created_at < ?", (cutoff,))
+        self.db.write("DELETE FROM segments WHERE created_at < ?", (cutoff,))
+
+    async def flush(self):
+        if self.db is not None:
+            await self.db.flush()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
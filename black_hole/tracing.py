@@ -0,0 +1,200 @@
+"""This module traces messages through the stages of the bridge, and helps
+inspect the running process.
+
+A sample of messages (see ``tracing.sample_rate``) gets a :class:`Trace`, which
+records when the message went through each stage on its way across the bridge.
+The time spent in each stage is exported as a metric, and messages that took
+longer than ``tracing.slow_threshold`` seconds are logged along with their
+stages.
+
+Traces aren't serialized along with webhook jobs. Instead, jobs carry the ID of
+their trace, and traces of jobs that were spilled or replayed are forgotten.
+IDs are random, so jobs read back after a restart never pick up the trace of
+another message.
+"""
+
+__all__ = [
+    "Trace",
+    "Tracer",
+    "all_tasks",
+    "measure_loop_lag",
+    "profile",
+    "profile_loop",
+    "summarize_tasks",
+]
+
+import asyncio
+import collections
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from typing import Optional
+
+from .metrics import STAGE_LATENCY
+from .store import LRU
+
+log = logging.getLogger(__name__)
+
+
+class Trace:
+    """The stages a single message went through, with the
+    :func:`time.monotonic` timestamp at which each stage ended.
+    """
+
+    __slots__ = ("id", "direction", "room", "started_at", "stages")
+
+    def __init__(self, id_: str, direction: str, room: str):
+        self.id = id_
+        self.direction = direction
+        self.room = room
+        self.started_at = time.monotonic()
+
+        #: [(stage, timestamp)]
+        self.stages = []
+
+    def mark(self, stage: str):
+        """Record the end of a stage."""
+        self.stages.append((stage, time.monotonic()))
+
+    @property
+    def duration(self) -> float:
+        if not self.stages:
+            return 0.0
+        return self.stages[-1][1] - self.started_at
+
+    def durations(self):
+        """Yield the time spent in each stage, in order."""
+        previous = self.started_at
+        for stage, timestamp in self.stages:
+            yield stage, timestamp - previous
+            previous = timestamp
+
+    def format(self) -> str:
+        stages = ", ".join(
+            f"{stage} +{duration * 1000:.0f}ms" for stage, duration in self.durations()
+        )
+        return (
+            f"[{self.room}] {self.direction} in {self.duration * 1000:.0f}ms: {stages}"
+        )
+
+
+class Tracer:
+    """Hands out traces to a sample of messages."""
+
+    def __init__(self, config):
+        self.config = config
+
+        #: The most recent slow traces.
+        self.slow = collections.deque(maxlen=20)
+
+        #: { str: Trace }
+        # traces that haven't finished yet
+        self._traces = LRU(max_entries=10000, max_age=10 * 60)
+
+    @property
+    def sample_rate(self) -> float:
+        return self.config.get("tracing", {}).get("sample_rate", 0)
+
+    @property
+    def slow_threshold(self) -> float:
+        return self.config.get("tracing", {}).get("slow_threshold", 2)
+
+    def start(self, direction: str, room: str) -> Optional[Trace]:
+        """Start tracing a message, if it's sampled."""
+        sample_rate = self.sample_rate
+        if not sample_rate or random.random() >= sample_rate:
+            return None
+
+        trace = Trace(uuid.uuid4().hex, direction, room)
+        self._traces.put(trace.id, trace)
+        return trace
+
+    def get(self, trace_id: Optional[str]) -> Optional[Trace]:
+        """Get an unfinished trace by its ID."""
+        if trace_id is None:
+            return None
+        return self._traces.get(trace_id)
+
+    def finish(self, trace: Trace):
+        """Record the stages of a trace, and log it if it was slow."""
+        self._traces.pop(trace.id)
+
+        for stage, duration in trace.durations():
+            STAGE_LATENCY.observe(duration, direction=trace.direction, stage=stage)
+
+        if trace.duration >= self.slow_threshold:
+            log.warning("slow message: %s", trace.format())
+            self.slow.append(trace)
+
+
+def all_tasks():
+    """Get every task that hasn't finished yet."""
+    if hasattr(asyncio, "all_tasks"):
+        return asyncio.all_tasks()
+    # python 3.6
+    return {task for task in asyncio.Task.all_tasks() if not task.done()}
+
+
+def summarize_tasks(tasks):
+    """Count tasks by the coroutine they run, most common first."""
+    counts = collections.Counter()
+    for task in tasks:
+        coro = task._coro
+        counts[getattr(coro, "__qualname__", None) or repr(coro)] += 1
+    return counts.most_common()
+
+
+async def measure_loop_lag(*, samples: int = 10, interval: float = 0.05) -> float:
+    """Measure how late the event loop runs callbacks, in seconds.
+
+    Returns the worst delay across a few short sleeps.
+    """
+    worst = 0.0
+    for _ in range(samples):
+        started_at = time.monotonic()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.monotonic() - started_at - interval)
+    return worst
+
+
+def profile(thread_id: int, duration: float, *, interval: float = 0.005):
+    """Sample the stack of a thread for a while, from another thread.
+
+    Returns two :class:`collections.Counter` of ``"file:line (function)"``
+    strings: how many samples each frame was at the top of the stack in, and
+    how many it was anywhere in the stack in.
+    """
+    own = collections.Counter()
+    total = collections.Counter()
+    deadline = time.monotonic() + duration
+
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+
+        top = True
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            location = f"{code.co_filename}:{code.co_firstlineno} ({code.co_name})"
+            if top:
+                own[location] += 1
+                top = False
+            if location not in seen:
+                seen.add(location)
+                total[location] += 1
+            frame = frame.f_back
+
+        time.sleep(interval)
+
+    return own, total
+
+
+async def profile_loop(duration: float):
+    """Sample the stack of the thread running the event loop."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, profile, threading.get_ident(), duration)
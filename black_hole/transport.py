@@ -0,0 +1,189 @@
+"""This module sends requests to Discord webhooks.
+
+Every webhook request goes through a single pooled HTTP session, which keeps
+connections to Discord alive between sends and caches DNS lookups. Payloads are
+serialized once, up front, so retrying a request doesn't serialize it again.
+
+Each webhook has a circuit breaker: webhooks that were deleted, or that keep
+failing, are skipped for a while instead of wasting time in a room's lane.
+"""
+
+__all__ = ["CircuitBreaker", "WebhookTransport", "backoff", "dumps", "is_retriable"]
+
+import asyncio
+import json
+import logging
+import random
+import time
+
+import aiohttp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+
+if orjson is not None:
+
+    def dumps(obj) -> bytes:
+        """Serialize an object to JSON."""
+        return orjson.dumps(obj)
+
+else:
+
+    def dumps(obj) -> bytes:
+        """Serialize an object to JSON."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+#: Errors after which a request is known to not have reached Discord, so even
+#: requests that aren't idempotent can be retried. These can only happen while
+#: connecting: once connected, the server may have processed the request even
+#: if it disconnected before responding.
+UNSENT_ERRORS = (aiohttp.ClientConnectorError,)
+
+#: Errors after which idempotent requests are retried.
+RETRIABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def backoff(attempt: int, *, base: float = 0.5, cap: float = 30) -> float:
+    """Compute a delay before retrying, with full jitter."""
+    return random.uniform(0, min(base * 2**attempt, cap))
+
+
+def is_retriable(method: str, error: Exception) -> bool:
+    """Check if a request that failed with an error can be safely retried."""
+    if isinstance(error, UNSENT_ERRORS):
+        return True
+
+    # editing a message twice is harmless, but posting it twice isn't
+    return method == "PATCH" and isinstance(error, RETRIABLE_ERRORS)
+
+
+class CircuitBreaker:
+    """Keeps track of failures of a single webhook.
+
+    After ``threshold`` consecutive failures, the breaker opens and requests
+    are skipped for ``cooldown`` seconds. After that, a single request is let
+    through: if it succeeds the breaker closes, otherwise it opens again.
+    """
+
+    __slots__ = ("key", "threshold", "cooldown", "failures", "opened_at", "dead")
+
+    def __init__(self, key, *, threshold: int, cooldown: float):
+        self.key = key
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        #: The amount of consecutive failures.
+        self.failures = 0
+
+        #: The :func:`time.monotonic` timestamp at which the breaker opened, or
+        #: ``None`` when it's closed.
+        self.opened_at = None
+
+        #: Whether the webhook is gone (deleted, or its token is invalid).
+        self.dead = False
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def retry_after(self) -> float:
+        """How long until a request may be made again, in seconds."""
+        if self.opened_at is None:
+            return 0.0
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """Check if a request may be made."""
+        if self.opened_at is None:
+            return True
+
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return False
+
+        # let a request through to see if the webhook has recovered, while
+        # keeping any others out until it's done
+        self.opened_at = time.monotonic()
+        return True
+
+    def succeeded(self):
+        if self.opened_at is not None:
+            log.info("webhook %s recovered", self.key)
+
+        self.failures = 0
+        self.opened_at = None
+        self.dead = False
+
+    def failed(self, *, dead: bool = False):
+        self.failures += 1
+        self.dead = dead
+
+        if dead or self.failures >= self.threshold:
+            if self.opened_at is None:
+                log.warning(
+                    "webhook %s %s, skipping it for %ds",
+                    self.key,
+                    "is gone" if dead else f"failed {self.failures} times",
+                    self.cooldown,
+                )
+            self.opened_at = time.monotonic()
+
+
+class WebhookTransport:
+    """A pooled HTTP session for webhook requests, with a circuit breaker per
+    webhook.
+    """
+
+    def __init__(self, *, loop, config):
+        connector = aiohttp.TCPConnector(
+            loop=loop,
+            limit=config.get("connections", 100),
+            keepalive_timeout=config.get("keepalive", 60),
+            use_dns_cache=True,
+            ttl_dns_cache=config.get("dns_cache", 300),
+            enable_cleanup_closed=True,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=config.get("timeout", 15), sock_connect=config.get("timeout", 15)
+        )
+
+        self.session = aiohttp.ClientSession(
+            loop=loop, connector=connector, timeout=timeout
+        )
+
+        self.threshold = config.get("failure_threshold", 5)
+        self.cooldown = config.get("cooldown", 30)
+
+        #: { str: CircuitBreaker }
+        self._breakers = {}
+
+    def breaker(self, webhook_url: str) -> CircuitBreaker:
+        """Get the circuit breaker of a webhook, creating it if needed."""
+        breaker = self._breakers.get(webhook_url)
+        if breaker is None:
+            breaker = self._breakers[webhook_url] = CircuitBreaker(
+                webhook_url.rsplit("/", 1)[0],
+                threshold=self.threshold,
+                cooldown=self.cooldown,
+            )
+        return breaker
+
+    def request(self, method: str, url: str, body: bytes):
+        """Make a request with a serialized JSON body, waiting for Discord to
+        return the message.
+        """
+        return self.session.request(
+            method,
+            url,
+            data=body,
+            params={"wait": "true"},
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def close(self):
+        await self.session.close()
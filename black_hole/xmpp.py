@@ -2,26 +2,44 @@ __all__ = ["XMPP"]
 
 import asyncio
 import logging
-from collections import namedtuple
+import time
 
 import aioxmpp
+import aioxmpp.misc
 import discord
-from discord.ext.commands import clean_content
 
+from . import metrics
+from .archive import Archive
+from .members import NameIndex
+from .outbox import Outbox
 from .room import Room
+from .sanitize import Sanitizer
+from .store import LRU
+from .tracing import Tracer
+from .xso import Fallback, Retract
 
 log = logging.getLogger(__name__)
 
-FakeContext = namedtuple("FakeContext", ("message", "guild", "bot"))
 
+def extract_message_content(message: discord.Message, *, media=None) -> str:
+    """Extract a message's content, along with any attachment URLs.
 
-def extract_message_content(message: discord.Message) -> str:
-    """Extract a message's content, along with any attachment URLs."""
+    With a :class:`black_hole.media.MediaRelay`, attachments are linked to
+    through it.
+    """
     base_content = message.system_content
 
     if message.attachments:
-        urls = " ".join(attachment.proxy_url for attachment in message.attachments)
-        base_content += " " + urls
+        if media is None:
+            urls = (attachment.proxy_url for attachment in message.attachments)
+        else:
+            urls = (
+                media.link(
+                    attachment.proxy_url, attachment.filename, size=attachment.size
+                )
+                for attachment in message.attachments
+            )
+        base_content += " " + " ".join(urls)
 
     if message.embeds:
         s = "" if len(message.embeds) == 1 else "s"
@@ -30,89 +48,419 @@ def extract_message_content(message: discord.Message) -> str:
     return base_content
 
 
-async def format_discord_message(client, message: discord.Message) -> str:
+def format_discord_message(
+    message: discord.Message, *, names: NameIndex, sanitizer: Sanitizer, media=None
+) -> str:
     """Format a Discord message into a string for XMPP."""
-    content = extract_message_content(message)
+    content = extract_message_content(message, media=media)
 
-    # Clean any mentions from the message using the clean_content converter,
-    # which is normally not supposed to be used in these circumstances (thus
-    # requiring a fake Context class).
-    cleaner = clean_content(use_nicknames=False)
-    ctx = FakeContext(message, message.guild, client)
-    content = await cleaner.convert(ctx, content)
+    # Clean any mentions from the message.
+    content = sanitizer.clean(message, content)
 
     # If someone else in this channel has the same username as the author,
     # present the user's discriminator in the forwarded message as well as the
     # username.
     presented_name = message.author.name
-    users = list(
-        filter(lambda user: user.name == message.author.name, message.channel.members)
-    )
-    if len(users) > 1:
+    if names.is_ambiguous(message.channel, message.author):
         presented_name = str(message.author)
 
     return f"<{presented_name}> {content}"
 
 
+class SentMessage:
+    """A Discord message that was bridged to a MUC."""
+
+    __slots__ = ("id", "stanza_id", "content")
+
+    def __init__(self, id_: str, content: str):
+        #: The ID of the stanza we sent, which corrections refer to.
+        self.id = id_
+
+        #: The ID the MUC assigned to the stanza, which retractions refer to.
+        #: ``None`` until the MUC reflects the stanza back to us, or if it
+        #: doesn't assign IDs.
+        self.stanza_id = None
+
+        #: The formatted content that was last sent.
+        self.content = content
+
+
 class XMPP:
     """Abstraction layer over aioxmpp."""
 
-    def __init__(self, jid: str, password: str, *, config):
+    def __init__(
+        self,
+        jid: str,
+        password: str,
+        *,
+        config,
+        router,
+        discord,
+        tracer=None,
+        media=None,
+    ):
         self.config = config
+        self.router = router
+
+        #: The :class:`black_hole.tracing.Tracer` of messages in both
+        #: directions.
+        self.tracer = tracer or Tracer(config)
+
+        #: The :class:`black_hole.media.MediaRelay` that attachments are linked
+        #: to through, if any.
+        self.media = media
+
+        #: The :class:`black_hole.discord.Discord` instance that messages are
+        #: bridged from.
+        self.discord = discord
         self.client = aioxmpp.PresenceManagedClient(
             aioxmpp.JID.fromstr(jid),
             aioxmpp.make_security_layer(password, no_verify=True),
         )
         self.muc = self.client.summon(aioxmpp.MUCClient)
 
+        # stream management is negotiated whenever the server supports it, so
+        # a stream that drops briefly is resumed without leaving any MUCs
+        resumption_timeout = config["xmpp"].get("resumption_timeout")
+        if resumption_timeout is not None:
+            self.client.resumption_timeout = resumption_timeout
+
+        self.client.on_stream_suspended.connect(self._on_stream_suspended)
+        self.client.on_stream_resumed.connect(self._on_stream_resumed)
+        self.client.on_stream_destroyed.connect(self._on_stream_destroyed)
+
+        #: The :class:`black_hole.archive.Archive` used to catch up on messages
+        #: after rejoining MUCs, or ``None`` if that's disabled.
+        self.archive = None
+        catch_up = config["xmpp"].get("catch_up", {})
+        if catch_up.get("enabled", True):
+            self.archive = Archive(
+                self.client,
+                page_size=catch_up.get("page_size", 50),
+                max_pages=catch_up.get("max_pages", 20),
+            )
+
+        #: { str: Room }
+        self.rooms = {}
+
+        #: { str: asyncio.Event }
+        # set once the room of a jid is created, for outboxes waiting on it
+        self._room_created = {}
+
+        #: Whether messages from MUCs are taken in. This is turned off when
+        #: shutting down.
+        self.receiving = True
+
+        #: { str: Outbox }
+        self._outboxes = {}
+
+        #: { int: SentMessage }
+        # maps discord message ids to the stanzas they were bridged as, so
+        # edits and deletions can be bridged as corrections and retractions.
+        map_config = config["xmpp"].get("message_map", {})
+        self.sent = LRU(
+            max_entries=map_config.get("max_entries", 10000),
+            max_age=map_config.get("max_age", 24 * 60 * 60),
+        )
+
+        #: { str: SentMessage }
+        # sent messages by stanza id, until the muc reflects them back.
+        self._unreflected = LRU(max_entries=1000, max_age=60)
+
+        #: Limits how many rooms are joined at once.
+        self._join_slots = asyncio.Semaphore(config["xmpp"].get("join_concurrency", 10))
+
+        #: Limits how many messages from MUCs are handled at once, across all
+        #: rooms.
+        self.handler_slots = asyncio.Semaphore(config["xmpp"].get("concurrency", 16))
+
+        metrics.QUEUE_DEPTH.add_function(lambda: self._collect_outbox_metrics("depth"))
+        metrics.QUEUE_DROPPED.add_function(
+            lambda: self._collect_outbox_metrics("dropped")
+        )
+        metrics.INBOX_DEPTH.add_function(
+            lambda: {(jid,): len(room._inbox) for jid, room in self.rooms.items()}
+        )
+        metrics.ROOMS_READY.add_function(
+            lambda: {(): sum(room.ready.is_set() for room in self.rooms.values())}
+        )
+        metrics.INBOX_DROPPED.add_function(
+            lambda: {(jid,): room.dropped for jid, room in self.rooms.items()}
+        )
+
         self.on_message_handlers = []
 
+    def _on_stream_suspended(self, reason):
+        log.warning("stream suspended (%r), trying to resume it", reason)
+
+    def _on_stream_resumed(self):
+        log.info("stream resumed")
+        metrics.STREAM_RESUMED.inc()
+
+    def _on_stream_destroyed(self, reason=None):
+        log.warning("stream destroyed (%r), rooms will be rejoined", reason)
+
     def on_message(self, func):
         """A decorator that adds a handler to be called upon a message."""
         self.on_message_handlers.append(func)
 
-    async def _handle_message(self, room, msg, member, source):
+    async def _handle_message(
+        self, room, msg, member, source, *, received_at, trace=None
+    ):
         """This method is called by :class:`blackhole.room.Room` instances."""
         for handler in self.on_message_handlers:
-            await handler(room, msg, member, source)
+            await handler(
+                room, msg, member, source, received_at=received_at, trace=trace
+            )
+
+    async def _join(self, room) -> bool:
+        async with self._join_slots:
+            return await room.join(
+                self.muc,
+                timeout=self.config["xmpp"].get("join_timeout", 30),
+                retries=self.config["xmpp"].get("join_retries", 3),
+            )
+
+    async def wait_for_room(self, jid: str):
+        """Wait until the room of a jid has been created, which happens once
+        we're connected, or once it's added to the configuration.
+        """
+        if jid in self.rooms:
+            return
+
+        created = self._room_created.get(jid)
+        if created is None:
+            created = self._room_created[jid] = asyncio.Event()
+        await created.wait()
 
-    def join_rooms(self):
-        """Joins all rooms as configured in the confuguration file.
+    async def join_rooms(self):
+        """Joins all rooms as configured in the confuguration file that we
+        haven't joined yet, a few at a time.
 
         This is automatically called when we connect to XMPP through
-        :meth:`boot_xmpp`.
+        :meth:`boot`.
         """
-        rooms = self.config["rooms"]
-        for room_config in rooms:
+        rooms = []
+        for room_config in self.router.rooms:
+            if room_config.jid in self.rooms:
+                continue
+
             # Room needs a reference to self in order to call _handle_message
-            room = Room(self, config=room_config)
-            room.join(self.muc)
+            room = self.rooms[room_config.jid] = Room(self, jid=room_config.jid)
+            rooms.append(room)
 
-    async def bridge(self, client, message, *, edited=False):
-        """Take a discord message and send it over to the MUC."""
-        room = discord.utils.find(
-            lambda room: room["channel_id"] == message.channel.id, self.config["rooms"]
+            created = self._room_created.pop(room_config.jid, None)
+            if created is not None:
+                created.set()
+
+        if not rooms:
+            return
+
+        started_at = time.monotonic()
+        results = await asyncio.gather(*(self._join(room) for room in rooms))
+
+        joined = [room for room, result in zip(rooms, results) if result]
+        log.info(
+            "joined %d of %d rooms in %.2fs",
+            len(joined),
+            len(rooms),
+            time.monotonic() - started_at,
         )
+        for room in sorted(joined, key=lambda room: -room.join_latency)[:5]:
+            log.info("  %s took %.2fs", room.jid, room.join_latency)
 
-        if not room or room.get("disabled", False):
+    async def sync_rooms(self):
+        """Join rooms that were added to the configuration, and leave rooms
+        that were removed from it. Rooms that are still configured are left
+        alone.
+        """
+        if not self.client.established:
+            # we'll join the configured rooms once we connect
             return
 
-        if room.get("discord_log", False):
+        for jid in list(self.rooms):
+            if self.router.by_jid(jid) is not None:
+                continue
+
+            log.info("leaving %s, it was removed from the configuration", jid)
+            room = self.rooms.pop(jid)
+            try:
+                await room.leave()
+            except Exception:
+                log.exception("failed to leave %s", jid)
+
+        for room_config in self.router.rooms:
+            if room_config.jid not in self.rooms:
+                log.info(
+                    "joining %s, it was added to the configuration", room_config.jid
+                )
+
+        await self.join_rooms()
+
+    async def drain_inboxes(self):
+        """Wait until every room has handled the messages in its inbox."""
+        await asyncio.gather(*(room.drain() for room in self.rooms.values()))
+
+    async def drain_outboxes(self):
+        """Wait until every outbox has been sent."""
+        await asyncio.gather(*(outbox.drain() for outbox in self._outboxes.values()))
+
+    @property
+    def pending(self) -> int:
+        """The amount of messages waiting to be handled or sent."""
+        return sum(len(room._inbox) for room in self.rooms.values()) + sum(
+            outbox.depth for outbox in self._outboxes.values()
+        )
+
+    def close(self):
+        """Stop handling and sending messages."""
+        for room in self.rooms.values():
+            room._task.cancel()
+        for outbox in self._outboxes.values():
+            outbox._task.cancel()
+
+    def _outbox_config(self, room_config) -> dict:
+        return {
+            **self.config["xmpp"].get("outbox", {}),
+            **room_config.raw.get("outbox", {}),
+        }
+
+    def outbox_for(self, room_config) -> Outbox:
+        """Get the outbox of a room, creating it if needed."""
+        key = room_config.jid
+        outbox = self._outboxes.get(key)
+        if outbox is None:
+            outbox = self._outboxes[key] = Outbox(
+                self, key, config=self._outbox_config(room_config)
+            )
+        return outbox
+
+    def reconfigure_outboxes(self):
+        """Apply changes to the configuration to existing outboxes."""
+        for key, outbox in self._outboxes.items():
+            room_config = self.router.by_jid(key)
+            if room_config is not None:
+                outbox.reconfigure(self._outbox_config(room_config))
+
+    def _collect_outbox_metrics(self, attribute: str):
+        return {
+            (key, "to_xmpp"): getattr(outbox, attribute)
+            for key, outbox in self._outboxes.items()
+        }
+
+    async def bridge(self, message, *, edited=False, received_at=None):
+        """Take a discord message and queue it up to be sent to the MUC.
+
+        Messages are formatted right away, so they're queued in the order
+        Discord delivered them.
+        """
+        room = self.router.by_channel(message.channel.id)
+
+        if room is None or room.disabled:
+            return
+
+        trace = self.tracer.start("to_xmpp", room.jid)
+
+        if room.discord_log:
             content = extract_message_content(message)
             log.info("[discord] <%s> %s", message.author, content)
 
-        reply = aioxmpp.Message(
-            type_=aioxmpp.MessageType.GROUPCHAT,
-            to=aioxmpp.JID.fromstr(room["jid"]),
+        formatted_content = format_discord_message(
+            message,
+            names=self.discord.names,
+            sanitizer=self.discord.sanitizer,
+            media=self.media,
         )
 
-        formatted_content = await format_discord_message(client, message)
+        if trace is not None:
+            trace.mark("formatted")
+
+        self.relay(
+            room,
+            formatted_content,
+            message_id=message.id,
+            edited=edited,
+            received_at=received_at,
+            trace=trace,
+        )
+
+    def _make_message(self, room) -> aioxmpp.Message:
+        stanza = aioxmpp.Message(
+            type_=aioxmpp.MessageType.GROUPCHAT,
+            to=aioxmpp.JID.fromstr(room.jid),
+        )
+        stanza.autoset_id()
+        stanza.xep0359_origin_id = aioxmpp.misc.OriginID(stanza.id_)
+        return stanza
+
+    def relay(
+        self,
+        room,
+        content: str,
+        *,
+        message_id=None,
+        edited=False,
+        received_at=None,
+        trace=None,
+    ):
+        """Queue up an already formatted message to be sent to a MUC.
+
+        Edits of messages we still remember are sent as corrections
+        (:xep:`308`), and skipped if the formatted content didn't change.
+        """
+        reply = self._make_message(room)
 
         if edited:
-            formatted_content += " (edited)"
+            sent = self.sent.get(message_id)
+            if sent is None:
+                # we don't know which stanza to correct, so send it anew
+                content += " (edited)"
+            elif sent.content == content:
+                log.debug("skipping edit of %s, nothing changed", message_id)
+                return
+            else:
+                reply.xep0308_replace = aioxmpp.misc.Replace()
+                reply.xep0308_replace.id_ = sent.id
+                sent.content = content
+        elif message_id is not None:
+            sent = SentMessage(reply.id_, content)
+            self.sent.put(message_id, sent)
+            self._unreflected.put(reply.id_, sent)
+
+        reply.body[None] = content
+        self.outbox_for(room).push(reply, received_at=received_at, trace=trace)
+
+        if trace is not None:
+            trace.mark("queued")
+
+    def retract(self, room, message_id):
+        """Retract a message that was deleted on Discord (:xep:`424`)."""
+        sent = self.sent.get(message_id)
+        if sent is None:
+            return
+
+        self.sent.pop(message_id)
+
+        retraction = self._make_message(room)
+        retraction.xep0424_retract = Retract(sent.stanza_id or sent.id)
+        retraction.xep0428_fallback.append(Fallback(Retract.TAG[0]))
+        retraction.body[None] = "(deleted a message)"
+        self.outbox_for(room).push(retraction)
+
+    def on_reflection(self, msg):
+        """Remember the stanza ID a MUC assigned to a message we sent.
+
+        This is called by :class:`black_hole.room.Room` instances.
+        """
+        origin_id = msg.xep0359_origin_id
+        sent = self._unreflected.get(origin_id.id_ if origin_id else msg.id_)
+        if sent is None:
+            return
 
-        reply.body[None] = formatted_content
-        await self.client.send(reply)
+        for stanza_id in msg.xep0359_stanza_ids:
+            if stanza_id.by is not None and stanza_id.by.bare() == msg.from_.bare():
+                sent.stanza_id = stanza_id.id_
+                break
 
     async def boot(self):
         log.info("connecting to xmpp...")
@@ -120,7 +468,7 @@ class XMPP:
         async with self.client.connected() as stream:
             log.debug("obtained stream: %s", stream)
 
-            self.join_rooms()
+            await self.join_rooms()
 
             while True:
                 await asyncio.sleep(60)
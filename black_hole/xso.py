@@ -0,0 +1,100 @@
+"""This module defines XSOs for XEPs that aioxmpp doesn't support (yet).
+
+They're registered on :class:`aioxmpp.Message` the same way aioxmpp registers
+its own, e.g. :class:`aioxmpp.misc.Replace`.
+"""
+
+__all__ = ["Retract", "Fallback", "MAMQuery", "MAMFin", "MAMResult"]
+
+import aioxmpp
+import aioxmpp.misc
+import aioxmpp.rsm.xso
+import aioxmpp.xso as xso
+from aioxmpp.utils import namespaces
+
+namespaces.xep0424_retract = "urn:xmpp:message-retract:1"
+namespaces.xep0428_fallback = "urn:xmpp:fallback:0"
+namespaces.xep0313_mam = "urn:xmpp:mam:2"
+
+
+class Retract(xso.XSO):
+    """A request to retract a previously sent message (:xep:`424`).
+
+    .. attribute:: id_
+
+       The identifier of the stanza to retract. In a MUC, this is the stanza
+       ID assigned by the MUC.
+    """
+
+    TAG = namespaces.xep0424_retract, "retract"
+
+    id_ = xso.Attr("id")
+
+    def __init__(self, id_=None):
+        super().__init__()
+        self.id_ = id_
+
+
+class Fallback(xso.XSO):
+    """Marks the body of a message as a fallback for clients that don't
+    support a XEP (:xep:`428`).
+    """
+
+    TAG = namespaces.xep0428_fallback, "fallback"
+
+    for_ = xso.Attr("for", default=None)
+
+    def __init__(self, for_=None):
+        super().__init__()
+        self.for_ = for_
+
+
+aioxmpp.Message.xep0424_retract = xso.Child([Retract])
+aioxmpp.Message.xep0428_fallback = xso.ChildList([Fallback])
+
+
+@aioxmpp.IQ.as_payload_class
+class MAMQuery(xso.XSO):
+    """A query for archived messages (:xep:`313`)."""
+
+    TAG = namespaces.xep0313_mam, "query"
+
+    queryid = xso.Attr("queryid", default=None)
+
+    rsm = xso.Child([aioxmpp.rsm.xso.ResultSetMetadata])
+
+    def __init__(self, queryid=None, rsm=None):
+        super().__init__()
+        self.queryid = queryid
+        self.rsm = rsm
+
+
+@aioxmpp.IQ.as_payload_class
+class MAMFin(xso.XSO):
+    """The end of the results of a :class:`MAMQuery`."""
+
+    TAG = namespaces.xep0313_mam, "fin"
+
+    complete = xso.Attr("complete", type_=xso.Bool(), default=False)
+
+    rsm = xso.Child([aioxmpp.rsm.xso.ResultSetMetadata])
+
+
+class MAMResult(xso.XSO):
+    """A single archived message, sent in response to a :class:`MAMQuery`.
+
+    .. attribute:: id_
+
+       The ID of the message in the archive, which is also its stanza ID.
+    """
+
+    TAG = namespaces.xep0313_mam, "result"
+
+    queryid = xso.Attr("queryid", default=None)
+
+    id_ = xso.Attr("id")
+
+    forwarded = xso.Child([aioxmpp.misc.Forwarded])
+
+
+aioxmpp.Message.xep0313_result = xso.Child([MAMResult])
@@ -2,7 +2,8 @@ import logging
 
 from ruamel.yaml import YAML
 
-from black_hole import BlackHole
+from black_hole import BlackHole, eventloop
+from black_hole.sharding import Supervisor
 
 if __name__ == '__main__':
     logging.basicConfig(level='INFO')
@@ -11,5 +12,11 @@ if __name__ == '__main__':
     with open('config.yaml', 'r') as fp:
         config = yaml.load(fp)
 
-    bh = BlackHole(config=config)
+    # this has to happen before anything creates the event loop
+    eventloop.install(config.get('loop', 'asyncio'))
+
+    if 'sharding' in config:
+        bh = Supervisor(config=config, config_path='config.yaml')
+    else:
+        bh = BlackHole(config=config, config_path='config.yaml')
     bh.run()